@@ -0,0 +1,239 @@
+import collections
+import contextlib
+import logging.config
+import queue
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__file__)
+
+# Как долго артикулы площадки считаются актуальными
+CATALOG_TTL = 6 * 60 * 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS catalog_accounts (
+    account TEXT PRIMARY KEY,
+    fetched_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS catalog_offers (
+    account TEXT NOT NULL,
+    sku TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    PRIMARY KEY (account, sku)
+) WITHOUT ROWID;
+"""
+
+
+class CatalogContext:
+    """Артикулы площадок, полученные за один запуск.
+
+    Каждый кабинет запрашивается у площадки не больше одного раза, даже
+    если артикулы одновременно нужны нескольким потокам. Возвращаемые
+    списки общие для всех вызывающих, изменять их нельзя.
+
+    Examples:
+        >>> context = CatalogContext()
+        >>> get_offer_ids(client_id, seller_token, context=context)
+        ["136748", "168448"]
+        >>> get_offer_ids(client_id, seller_token, context=context)  # без запроса
+        ["136748", "168448"]
+    """
+
+    def __init__(self):
+        self._offer_ids = {}
+        self._locks = collections.defaultdict(threading.Lock)
+        self._lock = threading.Lock()
+
+    def get_offer_ids(self, account, fetch):
+        """Получить артикулы кабинета, запросив их при первом обращении.
+
+        Args:
+            account (str): Кабинет площадки, например "ozon:123456".
+            fetch (callable): Функция без аргументов, запрашивающая
+            артикулы у площадки.
+
+        Returns:
+            offer_ids (list): Список артикулов площадки.
+        """
+        with self._lock:
+            account_lock = self._locks[account]
+        with account_lock:
+            if account not in self._offer_ids:
+                self._offer_ids[account] = fetch()
+            return self._offer_ids[account]
+
+
+@contextlib.contextmanager
+def open_catalog(path):
+    """Открыть базу артикулов площадок.
+
+    Args:
+        path (str): Путь к файлу SQLite.
+
+    Yields:
+        Connection: Соединение с базой. Изменения фиксируются при выходе
+        из блока без ошибок.
+    """
+    connection = sqlite3.connect(path, timeout=30)
+    try:
+        connection.executescript(SCHEMA)
+        with connection:
+            yield connection
+    finally:
+        connection.close()
+
+
+def load_offer_ids(path, account, ttl=CATALOG_TTL):
+    """Загрузить артикулы кабинета из базы.
+
+    Args:
+        path (str): Путь к файлу SQLite.
+        account (str): Кабинет площадки, например "ozon:123456".
+        ttl (float): Срок актуальности артикулов в секундах.
+
+    Returns:
+        offer_ids (list | None): Список артикулов в порядке площадки или
+        None, если артикулов нет или они устарели.
+    """
+    with open_catalog(path) as connection:
+        row = connection.execute(
+            "SELECT fetched_at FROM catalog_accounts WHERE account = ?", (account,)
+        ).fetchone()
+        if row is None or time.time() - row[0] > ttl:
+            return None
+        rows = connection.execute(
+            "SELECT sku FROM catalog_offers WHERE account = ? ORDER BY position",
+            (account,),
+        )
+        return [sku for sku, in rows]
+
+
+def save_offer_ids(path, account, offer_ids):
+    """Сохранить артикулы кабинета в базу, заменив прежние.
+
+    Args:
+        path (str): Путь к файлу SQLite.
+        account (str): Кабинет площадки, например "ozon:123456".
+        offer_ids (list): Список артикулов площадки.
+    """
+    with open_catalog(path) as connection:
+        connection.execute("DELETE FROM catalog_offers WHERE account = ?", (account,))
+        connection.executemany(
+            "INSERT OR IGNORE INTO catalog_offers (account, sku, position) "
+            "VALUES (?, ?, ?)",
+            ((account, sku, position) for position, sku in enumerate(offer_ids)),
+        )
+        connection.execute(
+            "INSERT OR REPLACE INTO catalog_accounts (account, fetched_at) "
+            "VALUES (?, ?)",
+            (account, time.time()),
+        )
+
+
+def has_offer(path, account, sku):
+    """Проверить по индексу, есть ли артикул в кабинете.
+
+    Args:
+        path (str): Путь к файлу SQLite.
+        account (str): Кабинет площадки, например "ozon:123456".
+        sku (str): Артикул товара.
+
+    Returns:
+        bool: True, если артикул есть в сохраненном каталоге.
+    """
+    with open_catalog(path) as connection:
+        row = connection.execute(
+            "SELECT 1 FROM catalog_offers WHERE account = ? AND sku = ?",
+            (account, sku),
+        ).fetchone()
+    return row is not None
+
+
+def cached_offer_ids(path, account, fetch, ttl=CATALOG_TTL, refresh=False):
+    """Получить артикулы кабинета из базы или с площадки.
+
+    Если в базе есть актуальные артикулы, площадка не запрашивается.
+    Иначе артикулы запрашиваются функцией fetch и сохраняются в базу.
+
+    Args:
+        path (str): Путь к файлу SQLite.
+        account (str): Кабинет площадки, например "ozon:123456".
+        fetch (callable): Функция без аргументов, запрашивающая артикулы
+        у площадки.
+        ttl (float): Срок актуальности артикулов в секундах.
+        refresh (bool): Запросить артикулы у площадки, даже если в базе
+        есть актуальные.
+
+    Returns:
+        offer_ids (list): Список артикулов площадки.
+
+    Examples:
+        >>> cached_offer_ids("catalog.sqlite3", "ozon:123456", fetch)
+        ["136748", "168448", "528148", "236297"]
+    """
+    if not refresh:
+        offer_ids = load_offer_ids(path, account, ttl)
+        if offer_ids is not None:
+            logger.info("%s: %d артикулов из кэша каталога", account, len(offer_ids))
+            return offer_ids
+    offer_ids = fetch()
+    save_offer_ids(path, account, offer_ids)
+    return offer_ids
+
+
+def prefetch(pages, depth=1):
+    """Запрашивать следующие страницы каталога в фоновом потоке.
+
+    Пока вызывающий код обрабатывает страницу, фоновый поток уже
+    запрашивает следующие, но не больше depth страниц наперед. Ошибка
+    запроса передается вызывающему коду при получении страницы.
+
+    Args:
+        pages (iterable): Генератор страниц, например iter_offer_id_pages.
+        depth (int): Сколько страниц можно запросить наперед.
+
+    Yields:
+        Страницы из pages в том же порядке.
+
+    Examples:
+        >>> for page in prefetch(iter_offer_id_pages(client_id, seller_token)):
+        ...     update_stocks(create_stocks(watch_remnants, page), ...)
+    """
+    done = object()
+    buffer = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item):
+        # Не ждем вечно, если вызывающий код перестал забирать страницы
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for page in pages:
+                if not put((page, None)):
+                    return
+        except Exception as error:
+            put((done, error))
+            return
+        put((done, None))
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            page, error = buffer.get()
+            if error is not None:
+                raise error
+            if page is done:
+                return
+            yield page
+    finally:
+        stop.set()
+        producer.join()
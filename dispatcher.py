@@ -0,0 +1,336 @@
+import asyncio
+import collections
+import concurrent.futures
+import logging.config
+import time
+
+import http_client
+import responses
+import retry
+
+logger = logging.getLogger(__file__)
+
+DispatchResult = collections.namedtuple(
+    "DispatchResult", ["name", "batches", "results", "errors", "elapsed"]
+)
+ResubmitResult = collections.namedtuple(
+    "ResubmitResult", ["dispatch", "accepted", "invalid", "failed"]
+)
+
+
+class DispatchError(Exception):
+    """Часть списка товаров не удалось отправить.
+
+    Attributes:
+        errors (dict): Ошибки по названиям выгрузок и номерам частей.
+    """
+
+    def __init__(self, errors):
+        self.errors = errors
+        failed = sum(len(batch_errors) for batch_errors in errors.values())
+        name, batch_errors = next(iter(errors.items()))
+        index, error = next(iter(batch_errors.items()))
+        super().__init__(
+            f"Не отправлено частей: {failed}, первая ошибка ({name}, "
+            f"часть {index}): {error}"
+        )
+
+
+def dispatch_batches(
+    batches,
+    upload,
+    max_workers=http_client.UPLOAD_CONCURRENCY,
+    name="выгрузка",
+    budget=None,
+):
+    """Отправить части списка товаров в пуле потоков.
+
+    Одновременно отправляется не больше max_workers частей, а из batches
+    берется не больше чем вдвое больше частей, чем отправляется, поэтому
+    генератор частей не перебирается целиком заранее. Ошибка одной части
+    не останавливает отправку остальных. Часть после временной ошибки
+    отправляется снова, см. retry.call_with_retry.
+
+    Args:
+        batches (iterable): Части списка товаров, например render_stocks.
+        upload (callable): Функция, отправляющая одну часть, например
+        update_stocks с заполненными остальными аргументами.
+        max_workers (int): Сколько частей отправляется одновременно.
+        name (str): Название выгрузки для журнала и ошибок.
+        budget (RetryBudget): Бюджет повторов запуска. Если не задан,
+        создается новый.
+
+    Returns:
+        DispatchResult: Кортеж из
+            name - названия выгрузки;
+            batches - отправленных частей по порядку;
+            results - ответов площадки в порядке частей, None для
+            неотправленных;
+            errors - ошибок по номерам частей;
+            elapsed - времени отправки в секундах, см. throughput.
+
+    Examples:
+        >>> dispatch_batches(
+        ...     render_stocks(offer_table, offer_ids),
+        ...     functools.partial(
+        ...         update_stocks, client_id=client_id, seller_token=seller_token
+        ...     ),
+        ... )
+        DispatchResult(
+            name='выгрузка', batches=[[...]], results=[{...}], errors={}, elapsed=0.4
+        )
+    """
+    if budget is None:
+        budget = retry.RetryBudget()
+    started = time.perf_counter()
+    sent = []
+    results = []
+    errors = {}
+    running = {}
+
+    def collect(done):
+        for future in done:
+            index = running.pop(future)
+            try:
+                results[index] = future.result()
+            except Exception as error:
+                errors[index] = error
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for index, batch in enumerate(batches):
+            if len(running) >= max_workers * 2:
+                done, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                collect(done)
+            sent.append(batch)
+            results.append(None)
+            future = executor.submit(
+                retry.call_with_retry, upload, batch, budget=budget
+            )
+            running[future] = index
+        done, _ = concurrent.futures.wait(running)
+        collect(done)
+    dispatch = DispatchResult(
+        name, sent, results, dict(sorted(errors.items())), time.perf_counter() - started
+    )
+    _log_dispatch(dispatch)
+    return dispatch
+
+
+async def dispatch_batches_async(batches, upload, name="выгрузка", budget=None):
+    """Отправить части списка товаров одновременно в цикле событий.
+
+    Асинхронный вариант dispatch_batches: сколько частей отправляется
+    одновременно, ограничивает upload, например семафор AsyncApiClient.
+    Ошибка одной части не останавливает отправку остальных. Часть после
+    временной ошибки отправляется снова, см. retry.call_with_retry_async.
+
+    Args:
+        batches (iterable): Части списка товаров.
+        upload (callable): Асинхронная функция, отправляющая одну часть,
+        например AsyncApiClient.send_batch с заполненными аргументами.
+        name (str): Название выгрузки для журнала и ошибок.
+        budget (RetryBudget): Бюджет повторов запуска. Если не задан,
+        создается новый.
+
+    Returns:
+        DispatchResult: То же, что и dispatch_batches.
+    """
+    if budget is None:
+        budget = retry.RetryBudget()
+    started = time.perf_counter()
+    sent = list(batches)
+    outcomes = await asyncio.gather(
+        *(retry.call_with_retry_async(upload, batch, budget=budget) for batch in sent),
+        return_exceptions=True,
+    )
+    results = []
+    errors = {}
+    for index, outcome in enumerate(outcomes):
+        if isinstance(outcome, Exception):
+            errors[index] = outcome
+            outcome = None
+        elif isinstance(outcome, BaseException):
+            raise outcome
+        results.append(outcome)
+    dispatch = DispatchResult(
+        name, sent, results, errors, time.perf_counter() - started
+    )
+    _log_dispatch(dispatch)
+    return dispatch
+
+
+def _log_dispatch(dispatch):
+    logger.info(
+        "%s: %d частей, %d товаров за %.1f с (%.0f товаров/с), ошибок: %d",
+        dispatch.name,
+        len(dispatch.batches),
+        sum(len(batch) for batch in dispatch.batches),
+        dispatch.elapsed,
+        throughput(dispatch),
+        len(dispatch.errors),
+    )
+
+
+def throughput(dispatch):
+    """Вычислить скорость выгрузки.
+
+    Args:
+        dispatch (DispatchResult): Результат dispatch_batches.
+
+    Returns:
+        float: Отправленных товаров в секунду, считая части с ошибками.
+    """
+    items = sum(len(batch) for batch in dispatch.batches)
+    return items / dispatch.elapsed if dispatch.elapsed else 0.0
+
+
+def raise_for_errors(*dispatches):
+    """Сообщить об ошибках нескольких выгрузок одним исключением.
+
+    Args:
+        *dispatches (DispatchResult): Результаты dispatch_batches.
+
+    Raises:
+        DispatchError: Если хотя бы одна часть не отправлена.
+    """
+    errors = {
+        dispatch.name: dispatch.errors for dispatch in dispatches if dispatch.errors
+    }
+    if errors:
+        raise DispatchError(errors)
+
+
+def sent_items(dispatch):
+    """Собрать товары из успешно отправленных частей.
+
+    Args:
+        dispatch (DispatchResult): Результат dispatch_batches.
+
+    Returns:
+        list: Товары отправленных частей в исходном порядке.
+    """
+    return [
+        item
+        for index, batch in enumerate(dispatch.batches)
+        if index not in dispatch.errors
+        for item in batch
+    ]
+
+
+def resubmit_failed(
+    dispatch,
+    upload,
+    analyze,
+    key,
+    rebatch,
+    max_workers=http_client.UPLOAD_CONCURRENCY,
+    budget=None,
+):
+    """Отправить снова только товары, которые площадка не обновила.
+
+    Ответы площадки разбираются analyze. Товары с ошибками из
+    responses.PERMANENT_ERRORS не отправляются, остальные собираются в
+    новые плотные части rebatch и отправляются один раз. Так из-за одного
+    товара не отправляется снова вся часть.
+
+    Args:
+        dispatch (DispatchResult): Результат dispatch_batches.
+        upload (callable): Функция, отправляющая одну часть.
+        analyze (callable): Разбор ответа, например
+        responses.ozon_item_errors.
+        key (str): Поле артикула в товаре, например "offer_id".
+        rebatch (callable): Делит список товаров на части.
+        max_workers (int): Сколько частей отправляется одновременно.
+        budget (RetryBudget): Бюджет повторов запуска.
+
+    Returns:
+        ResubmitResult: Кортеж из
+            dispatch - результата повторной выгрузки;
+            accepted - товаров, принятых площадкой;
+            invalid - постоянных ошибок по артикулам;
+            failed - ошибок по артикулам товаров, не принятых и после
+            повтора.
+    """
+    accepted, failed_items, invalid = _split_failed(dispatch, analyze, key)
+    if not failed_items:
+        return _skip_resubmit(dispatch, accepted, invalid)
+    logger.info("%s: повтор %d товаров с ошибками", dispatch.name, len(failed_items))
+    resubmit = dispatch_batches(
+        rebatch(failed_items),
+        upload,
+        max_workers,
+        f"{dispatch.name}: повтор",
+        budget,
+    )
+    return _merge_resubmit(dispatch, resubmit, analyze, key, accepted, invalid)
+
+
+async def resubmit_failed_async(dispatch, upload, analyze, key, rebatch, budget=None):
+    """Отправить снова только товары, которые площадка не обновила.
+
+    Асинхронный вариант resubmit_failed для dispatch_batches_async.
+
+    Args:
+        dispatch (DispatchResult): Результат dispatch_batches_async.
+        upload (callable): Асинхронная функция, отправляющая одну часть.
+        analyze (callable): Разбор ответа, например
+        responses.ozon_item_errors.
+        key (str): Поле артикула в товаре, например "offer_id".
+        rebatch (callable): Делит список товаров на части.
+        budget (RetryBudget): Бюджет повторов запуска.
+
+    Returns:
+        ResubmitResult: То же, что и resubmit_failed.
+    """
+    accepted, failed_items, invalid = _split_failed(dispatch, analyze, key)
+    if not failed_items:
+        return _skip_resubmit(dispatch, accepted, invalid)
+    logger.info("%s: повтор %d товаров с ошибками", dispatch.name, len(failed_items))
+    resubmit = await dispatch_batches_async(
+        rebatch(failed_items), upload, f"{dispatch.name}: повтор", budget
+    )
+    return _merge_resubmit(dispatch, resubmit, analyze, key, accepted, invalid)
+
+
+def _split_failed(dispatch, analyze, key):
+    # Принятые товары, товары для повтора и постоянные ошибки по артикулам
+    errors = responses.item_errors(dispatch, analyze)
+    invalid = {
+        sku: error for sku, error in errors.items() if responses.is_permanent(error)
+    }
+    sent = sent_items(dispatch)
+    accepted = [item for item in sent if str(item[key]) not in errors]
+    failed_items = [
+        item
+        for item in sent
+        if str(item[key]) in errors and str(item[key]) not in invalid
+    ]
+    return accepted, failed_items, invalid
+
+
+def _skip_resubmit(dispatch, accepted, invalid):
+    empty = DispatchResult(f"{dispatch.name}: повтор", [], [], {}, 0.0)
+    return ResubmitResult(empty, accepted, invalid, {})
+
+
+def _merge_resubmit(dispatch, resubmit, analyze, key, accepted, invalid):
+    retry_errors = responses.item_errors(resubmit, analyze)
+    failed = {}
+    for sku, error in retry_errors.items():
+        if responses.is_permanent(error):
+            invalid[sku] = error
+        else:
+            failed[sku] = error
+    accepted += [
+        item for item in sent_items(resubmit) if str(item[key]) not in retry_errors
+    ]
+    if failed:
+        logger.warning(
+            "%s: площадка не приняла %d товаров, первая ошибка: %s",
+            dispatch.name,
+            len(failed),
+            next(iter(failed.values())),
+        )
+    return ResubmitResult(resubmit, accepted, invalid, failed)
@@ -0,0 +1,409 @@
+import collections
+import json
+import logging.config
+import os
+import time
+
+import numpy as np
+
+from remnants import diff_remnants, snapshot_remnants
+
+logger = logging.getLogger(__file__)
+
+FEED_META_FILE = "feed_meta.json"
+PARSED_DIR = "parsed"
+PARSED_CACHE_MAX_BYTES = 64 * 1024 * 1024
+SNAPSHOT_DIR = "snapshots"
+INVALID_DIR = "invalid"
+# Через сколько снова пробовать выгрузить товары, отклоненные площадкой
+INVALID_OFFER_TTL = 7 * 24 * 60 * 60
+# Как часто выгружать все товары, даже если фид не менялся
+FULL_SYNC_INTERVAL = 24 * 60 * 60
+# Колонки файла остатков, которые нужны для выгрузки на площадки
+REMNANT_COLUMNS = {
+    "Код": "code",
+    "Цена": "price",
+    "Количество": "count",
+}
+
+
+def _read_json(path):
+    try:
+        with open(path, encoding="utf-8") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_json(path, data):
+    # Пишем во временный файл и подменяем, чтобы параллельные запуски
+    # не прочитали недописанный кэш
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        json.dump(data, file, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def _parsed_path(cache_dir, digest):
+    return os.path.join(cache_dir, PARSED_DIR, f"{digest}.npz")
+
+
+def _encode_column(values):
+    # Колонка хранится строками, а маска отмечает целые числа, чтобы из
+    # кэша они вернулись int, как при разборе файла
+    is_int = np.array(
+        [isinstance(value, int) and not isinstance(value, bool) for value in values],
+        dtype=bool,
+    )
+    text = np.array(
+        ["" if value is None else str(value) for value in values], dtype=str
+    )
+    return text, is_int
+
+
+def _decode_column(text, is_int):
+    return [
+        int(value) if value_is_int else value
+        for value, value_is_int in zip(text.tolist(), is_int.tolist())
+    ]
+
+
+def conditional_headers(cache_dir):
+    """Сформировать заголовки условного запроса архива остатков.
+
+    Заголовки формируются, только если в кэше есть и валидаторы прошлого
+    ответа, и разобранные по нему остатки.
+
+    Args:
+        cache_dir (str): Директория кэша фида.
+
+    Returns:
+        headers (dict): Заголовки If-None-Match и If-Modified-Since.
+
+    Examples:
+        >>> conditional_headers(".feed_cache")
+        {
+            "If-None-Match": "\"5f3a-61c2\"",
+            "If-Modified-Since": "Sun, 13 Aug 2023 19:50:21 GMT"
+        }
+
+        >>> conditional_headers(".feed_cache")
+        {}
+    """
+    meta = _read_json(os.path.join(cache_dir, FEED_META_FILE))
+    if not meta or not meta.get("sha256"):
+        return {}
+    if not os.path.exists(_parsed_path(cache_dir, meta.get("sha256"))):
+        return {}
+    headers = {}
+    if meta.get("etag"):
+        headers["If-None-Match"] = meta.get("etag")
+    if meta.get("last_modified"):
+        headers["If-Modified-Since"] = meta.get("last_modified")
+    return headers
+
+
+def save_feed_meta(cache_dir, response, digest):
+    """Сохранить валидаторы ответа и хэш скачанного архива.
+
+    Args:
+        cache_dir (str): Директория кэша фида.
+        response (Response): Ответ timeworld.ru с архивом остатков.
+        digest (str): SHA-256 архива.
+    """
+    meta = {
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+        "sha256": digest,
+    }
+    _write_json(os.path.join(cache_dir, FEED_META_FILE), meta)
+
+
+def load_last_remnants(cache_dir):
+    """Загрузить остатки, разобранные при прошлом скачивании.
+
+    Используется при ответе 304, когда архив не изменился.
+
+    Args:
+        cache_dir (str): Директория кэша фида.
+
+    Returns:
+        watch_remnants (list | None): Список словарей с информацией о
+        товарах или None, если кэш пуст или поврежден.
+    """
+    meta = _read_json(os.path.join(cache_dir, FEED_META_FILE))
+    if not meta or not meta.get("sha256"):
+        return None
+    return load_parsed(cache_dir, meta.get("sha256"))
+
+
+def load_parsed(cache_dir, digest):
+    """Загрузить разобранные остатки по хэшу архива.
+
+    Args:
+        cache_dir (str): Директория кэша фида.
+        digest (str): SHA-256 архива.
+
+    Returns:
+        watch_remnants (list | None): Список словарей с колонками Код, Цена
+        и Количество или None, если архив еще не разбирался. Целые числа и
+        строки возвращаются такими же, как при разборе файла.
+
+    Examples:
+        >>> load_parsed(".feed_cache", digest)
+        [
+            {
+                "Код": 48852,
+                "Цена": "24'570.00 руб.",
+                "Количество": "1"
+            }
+        ]
+    """
+    path = _parsed_path(cache_dir, digest)
+    try:
+        with np.load(path, allow_pickle=False) as parsed:
+            columns = {
+                column: _decode_column(parsed[key], parsed[f"{key}_int"])
+                for column, key in REMNANT_COLUMNS.items()
+            }
+    except (OSError, ValueError, KeyError):
+        return None
+    # Обновим время изменения, чтобы вытеснялись давно не нужные записи.
+    # Запись мог уже вытеснить другой процесс, остатки при этом прочитаны
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        pass
+    return [dict(zip(columns, row)) for row in zip(*columns.values())]
+
+
+def save_parsed(cache_dir, digest, watch_remnants, max_bytes=PARSED_CACHE_MAX_BYTES):
+    """Сохранить разобранные остатки в колоночном формате.
+
+    Сохраняет только колонки Код, Цена и Количество в npz-файл, названный
+    по хэшу архива. Целые числа и строки сохраняются с типом, пустые
+    значения - пустыми строками, остальные значения - строками. Если кэш
+    превышает max_bytes, удаляет записи, которые дольше всего не
+    использовались.
+
+    Args:
+        cache_dir (str): Директория кэша фида.
+        digest (str): SHA-256 архива.
+        watch_remnants (list): Список словарей с информацией о товарах.
+        max_bytes (int): Максимальный размер кэша разобранных остатков.
+    """
+    path = _parsed_path(cache_dir, digest)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    columns = {}
+    for column, key in REMNANT_COLUMNS.items():
+        columns[key], columns[f"{key}_int"] = _encode_column(
+            [watch.get(column) for watch in watch_remnants]
+        )
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as file:
+        np.savez(file, **columns)
+    os.replace(tmp_path, path)
+    evict_parsed(cache_dir, max_bytes, keep=path)
+
+
+def evict_parsed(cache_dir, max_bytes, keep=None):
+    """Ограничить размер кэша разобранных остатков.
+
+    Args:
+        cache_dir (str): Директория кэша фида.
+        max_bytes (int): Максимальный размер кэша разобранных остатков.
+        keep (str): Путь к записи, которую нельзя удалять.
+    """
+    parsed_dir = os.path.join(cache_dir, PARSED_DIR)
+    entries = []
+    for entry in os.scandir(parsed_dir):
+        if entry.name.endswith(".npz"):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                # Запись удалил другой процесс
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        logger.info("Удален разобранный фид из кэша: %s", path)
+
+
+SyncPlan = collections.namedtuple(
+    "SyncPlan", ["stock_skus", "price_skus", "snapshot", "full_sync_at"]
+)
+
+
+def _snapshot_path(cache_dir, name):
+    return os.path.join(cache_dir, SNAPSHOT_DIR, f"{name}.npz")
+
+
+def load_snapshot(cache_dir, name):
+    """Загрузить снимок остатков, выгруженных при прошлом запуске.
+
+    Args:
+        cache_dir (str): Директория кэша фида.
+        name (str): Имя снимка, например площадка и кабинет.
+
+    Returns:
+        snapshot (dict | None): Количество и цена товаров по артикулам или
+        None, если снимка нет.
+        full_sync_at (float): Время последней полной выгрузки.
+    """
+    try:
+        with np.load(_snapshot_path(cache_dir, name), allow_pickle=False) as data:
+            snapshot = dict(
+                zip(
+                    data["skus"].tolist(),
+                    zip(data["stocks"].tolist(), data["prices"].tolist()),
+                )
+            )
+            full_sync_at = float(data["full_sync_at"])
+    except (OSError, ValueError, KeyError):
+        return None, 0.0
+    return snapshot, full_sync_at
+
+
+def save_snapshot(cache_dir, name, snapshot, full_sync_at):
+    """Сохранить снимок выгруженных остатков.
+
+    Args:
+        cache_dir (str): Директория кэша фида.
+        name (str): Имя снимка, например площадка и кабинет.
+        snapshot (dict): Количество и цена товаров по артикулам.
+        full_sync_at (float): Время последней полной выгрузки.
+    """
+    path = _snapshot_path(cache_dir, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    values = list(snapshot.values())
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as file:
+        np.savez(
+            file,
+            skus=np.array(list(snapshot), dtype=str),
+            stocks=np.array([stock for stock, _ in values], dtype=np.int64),
+            prices=np.array([price for _, price in values], dtype=np.int64),
+            full_sync_at=np.array(full_sync_at),
+        )
+    os.replace(tmp_path, path)
+
+
+def plan_sync(cache_dir, name, watch_remnants, full_sync_interval=FULL_SYNC_INTERVAL):
+    """Определить, какие товары нужно выгрузить на площадку.
+
+    Сравнивает остатки со снимком прошлой выгрузки. Если снимка нет или
+    с последней полной выгрузки прошло больше full_sync_interval секунд,
+    выгружать нужно все товары.
+
+    Args:
+        cache_dir (str): Директория кэша фида.
+        name (str): Имя снимка, например площадка и кабинет.
+        watch_remnants (list | OfferTable): Список словарей с информацией
+        о товарах или таблица предложений.
+        full_sync_interval (float): Период полной выгрузки в секундах.
+
+    Returns:
+        SyncPlan: Кортеж из
+            stock_skus (set | None) - артикулов, остатки которых нужно
+            обновить, или None, если нужно обновить все;
+            price_skus (set | None) - артикулов, цены которых нужно
+            обновить, или None, если нужно обновить все;
+            snapshot (dict) - снимка текущих остатков;
+            full_sync_at (float) - времени последней полной выгрузки.
+        Снимок нужно сохранить через save_snapshot после успешной выгрузки.
+
+    Examples:
+        >>> plan_sync(".feed_cache", "ozon_123", watch_remnants)
+        SyncPlan(
+            stock_skus={'48852', '48857'},
+            price_skus={'48857'},
+            snapshot={...},
+            full_sync_at=1691956221.0
+        )
+    """
+    current = snapshot_remnants(watch_remnants)
+    previous, full_sync_at = load_snapshot(cache_dir, name)
+    now = time.time()
+    if previous is None or now - full_sync_at >= full_sync_interval:
+        return SyncPlan(None, None, current, now)
+    diff = diff_remnants(previous, current)
+    stock_skus = diff.added | diff.removed | diff.stock_changed
+    price_skus = diff.added | diff.price_changed
+    logger.info(
+        "%s: изменились остатки %d и цены %d товаров",
+        name,
+        len(stock_skus),
+        len(price_skus),
+    )
+    return SyncPlan(stock_skus, price_skus, current, full_sync_at)
+
+
+def _invalid_path(cache_dir, name):
+    return os.path.join(cache_dir, INVALID_DIR, f"{name}.json")
+
+
+def load_invalid_offers(cache_dir, name, ttl=INVALID_OFFER_TTL):
+    """Загрузить артикулы, которые площадка отклонила без права повтора.
+
+    Args:
+        cache_dir (str): Директория кэша фида.
+        name (str): Имя списка, например площадка и кабинет.
+        ttl (float): Сколько секунд не выгружать отклоненный артикул.
+
+    Returns:
+        invalid_offers (dict): Код и текст ошибки и время отказа по
+        артикулам. Устаревшие артикулы не возвращаются.
+
+    Examples:
+        >>> load_invalid_offers(".feed_cache", "ozon_123")
+        {
+            "48852": {
+                "code": "NOT_FOUND",
+                "message": "Product not found",
+                "failed_at": 1691956221.0
+            }
+        }
+    """
+    invalid_offers = _read_json(_invalid_path(cache_dir, name)) or {}
+    now = time.time()
+    return {
+        sku: error
+        for sku, error in invalid_offers.items()
+        if now - error.get("failed_at", 0) < ttl
+    }
+
+
+def save_invalid_offers(cache_dir, name, errors, ttl=INVALID_OFFER_TTL):
+    """Добавить отклоненные площадкой артикулы к сохраненным.
+
+    Args:
+        cache_dir (str): Директория кэша фида.
+        name (str): Имя списка, например площадка и кабинет.
+        errors (dict): Ошибки ItemError по артикулам.
+        ttl (float): Сколько секунд не выгружать отклоненный артикул.
+    """
+    invalid_offers = load_invalid_offers(cache_dir, name, ttl)
+    now = time.time()
+    for sku, error in errors.items():
+        invalid_offers[sku] = {
+            "code": error.code,
+            "message": error.message,
+            "failed_at": now,
+        }
+    _write_json(_invalid_path(cache_dir, name), invalid_offers)
+    logger.warning(
+        "%s: площадка отклонила %d товаров, они не будут выгружаться %d ч",
+        name,
+        len(errors),
+        ttl // 3600,
+    )
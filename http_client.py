@@ -0,0 +1,225 @@
+import asyncio
+import logging.config
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import payloads
+import rate_limit
+
+logger = logging.getLogger(__file__)
+
+# Сколько запросов к одной площадке выполняется одновременно
+UPLOAD_CONCURRENCY = 4
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 60
+
+
+class ApiClient:
+    """Постоянное соединение с API площадки.
+
+    Держит пул соединений keep-alive, поэтому TCP и TLS устанавливаются
+    один раз на соединение, а не на каждый запрос. Заголовки авторизации
+    собираются один раз при создании. Один клиент можно использовать из
+    нескольких потоков одновременно, пока их не больше pool_size.
+    Перед каждым запросом клиент ждет разрешения ограничителя limiter по
+    ключу (площадка, метод API, кабинет).
+
+    Attributes:
+        base_url (str): Адрес API площадки со слешем в конце.
+        headers (dict): Заголовки авторизации и JSON.
+        session (Session): Сессия requests с пулом соединений.
+        timeout (tuple): Время ожидания соединения и ответа в секундах.
+        marketplace (str): Название площадки для лимитов запросов.
+        account (str): Кабинет по умолчанию для лимитов запросов.
+        limiter (RateLimiter): Ограничитель запросов или None.
+
+    Examples:
+        >>> client = ApiClient(
+        ...     "https://api-seller.ozon.ru/",
+        ...     {"Client-Id": client_id, "Api-Key": seller_token},
+        ...     marketplace="ozon",
+        ...     account=client_id,
+        ... )
+        >>> client.post("v2/product/list", data=body)
+        {"result": {"items": [], "total": 0, "last_id": ""}}
+    """
+
+    def __init__(
+        self,
+        base_url,
+        headers,
+        pool_size=UPLOAD_CONCURRENCY,
+        timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
+        marketplace=None,
+        account=None,
+        limiter=rate_limit.LIMITER,
+    ):
+        self.base_url = base_url
+        self.headers = payloads.json_headers(headers)
+        self.timeout = timeout
+        self.marketplace = marketplace
+        self.account = account
+        self.limiter = limiter
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount(base_url, adapter)
+
+    def rate_key(self, path, endpoint=None, account=None):
+        """Собрать ключ лимита запросов.
+
+        Args:
+            path (str): Путь относительно base_url.
+            endpoint (str): Метод API, если путь содержит идентификаторы.
+            account (str): Кабинет, если он отличается от account клиента.
+
+        Returns:
+            tuple: Площадка, метод API и кабинет.
+        """
+        return (self.marketplace, endpoint or path, account or self.account)
+
+    def request(self, method, path, endpoint=None, account=None, **kwargs):
+        """Выполнить запрос к API площадки.
+
+        Args:
+            method (str): HTTP-метод.
+            path (str): Путь относительно base_url.
+            endpoint (str): Метод API для лимитов запросов, по умолчанию
+            path.
+            account (str): Кабинет для лимитов запросов.
+            **kwargs: Аргументы Session.request, например data или params.
+
+        Returns:
+            dict: Ответ площадки.
+
+        Raises:
+            HTTPError: Если код ответа не 200.
+        """
+        key = self.rate_key(path, endpoint, account)
+        if self.limiter is not None:
+            self.limiter.acquire(key)
+        kwargs.setdefault("timeout", self.timeout)
+        response = self.session.request(method, self.base_url + path, **kwargs)
+        if self.limiter is not None:
+            self.limiter.observe(key, response.status_code, response.headers)
+        response.raise_for_status()
+        return response.json()
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+    def put(self, path, **kwargs):
+        return self.request("PUT", path, **kwargs)
+
+    def close(self):
+        """Закрыть соединения пула."""
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class AsyncApiClient:
+    """Неблокирующий клиент API площадки для asyncio на aiohttp.
+
+    Одновременно выполняется не больше concurrency запросов. Адрес,
+    заголовки, время ожидания и лимиты запросов берутся у синхронного
+    клиента. Использовать только внутри async with.
+
+    Attributes:
+        client (ApiClient): Синхронный клиент с адресом, заголовками и
+        временем ожидания площадки.
+        concurrency (int): Сколько запросов выполняется одновременно.
+
+    Examples:
+        >>> async with AsyncApiClient(get_client(client_id, seller_token)) as client:
+        ...     await client.send_batch("POST", path, "stocks", stocks)
+        {"result": [...]}
+    """
+
+    def __init__(self, client, concurrency=UPLOAD_CONCURRENCY):
+        self.client = client
+        self.concurrency = concurrency
+        self._semaphore = None
+        self._session = None
+
+    async def __aenter__(self):
+        # aiohttp загружается долго и нужен только асинхронной выгрузке,
+        # поэтому импортируется здесь, а не при запуске
+        try:
+            import aiohttp
+        except ImportError as error:
+            raise ImportError("Для асинхронной выгрузки нужен aiohttp") from error
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        connect_timeout, read_timeout = self.client.timeout
+        self._session = aiohttp.ClientSession(
+            headers=self.client.headers,
+            timeout=aiohttp.ClientTimeout(
+                sock_connect=connect_timeout, sock_read=read_timeout
+            ),
+            connector=aiohttp.TCPConnector(limit=self.concurrency),
+        )
+        return self
+
+    async def __aexit__(self, *exc_info):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def request(self, method, path, endpoint=None, account=None, **kwargs):
+        """Выполнить запрос к API площадки, не блокируя цикл событий.
+
+        Args:
+            method (str): HTTP-метод.
+            path (str): Путь относительно адреса API площадки.
+            endpoint (str): Метод API для лимитов запросов, по умолчанию
+            path.
+            account (str): Кабинет для лимитов запросов.
+            **kwargs: Тело запроса data или параметры params.
+
+        Returns:
+            dict: Ответ площадки.
+
+        Raises:
+            ClientResponseError: Если код ответа не 200.
+        """
+        async with self._semaphore:
+            key = self.client.rate_key(path, endpoint, account)
+            limiter = self.client.limiter
+            if limiter is not None:
+                await limiter.acquire_async(key)
+            async with self._session.request(
+                method, self.client.base_url + path, **kwargs
+            ) as response:
+                if limiter is not None:
+                    limiter.observe(key, response.status, response.headers)
+                response.raise_for_status()
+                return await response.json(content_type=None)
+
+    async def send_batch(self, method, path, key, batch, endpoint=None, account=None):
+        """Отправить одну часть списка товаров.
+
+        Args:
+            method (str): HTTP-метод.
+            path (str): Путь относительно адреса API площадки.
+            key (str): Ключ списка в теле запроса, например "stocks".
+            batch (list): Часть списка товаров.
+            endpoint (str): Метод API для лимитов запросов.
+            account (str): Кабинет для лимитов запросов.
+
+        Returns:
+            dict: Ответ площадки.
+
+        Raises:
+            ClientResponseError: Если код ответа не 200.
+        """
+        return await self.request(
+            method, path, endpoint, account, data=payloads.encode(key, batch)
+        )
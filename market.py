@@ -1,16 +1,58 @@
+import asyncio
 import datetime
+import functools
+import itertools
 import logging.config
 from environs import Env
 from seller import download_stock
 
 import requests
 
-from seller import divide, price_conversion
+import catalog
+import dispatcher
+import feed_cache
+import http_client
+import payloads
+import rate_limit
+import responses
+import retry
+from remnants import OfferTable
+from seller import batched
 
 logger = logging.getLogger(__file__)
 
+# Ограничения Яндекс Маркета на один запрос обновления остатков и цен
+STOCKS_BATCH_SIZE = 2000
+PRICES_BATCH_SIZE = 500
+BATCH_MAX_BYTES = 1024 * 1024
+MARKET_API_URL = "https://api.partner.market.yandex.ru/"
 
-def get_product_list(page, campaign_id, access_token):
+
+@functools.lru_cache(maxsize=None)
+def get_client(access_token, pool_size=http_client.UPLOAD_CONCURRENCY):
+    """Получить клиент API Яндекс Маркета для токена продавца.
+
+    Для одного токена и размера пула возвращается один и тот же клиент,
+    поэтому все запросы запуска, в том числе к разным кампаниям, идут
+    через общий пул соединений.
+
+    Args:
+        access_token (str): API-токен продавца Яндекс Маркета.
+        pool_size (int): Сколько соединений держать открытыми.
+
+    Returns:
+        ApiClient: Клиент API Яндекс Маркета.
+    """
+    headers = {
+        "Authorization": f"Bearer {access_token}",
+        "Accept": "application/json",
+    }
+    return http_client.ApiClient(
+        MARKET_API_URL, headers, pool_size, marketplace="yandex"
+    )
+
+
+def get_product_list(page, campaign_id, access_token, client=None):
     """Получить список товаров Яндекс Маркета.
 
     Обращается к API Яндекс Маркета за списком созданных товаров.
@@ -20,6 +62,8 @@ def get_product_list(page, campaign_id, access_token):
         campaign_id (str): Идентификатор кампании и идентификатор магазина
         Яндекс Маркета.
         access_token (str): API-токен продавца Яндекс Маркета.
+        client (ApiClient): Клиент API Яндекс Маркета. Если не задан,
+        используется общий клиент токена, см. get_client.
 
     Returns:
         dict: Ответ Яндекс Маркета.
@@ -128,25 +172,20 @@ def get_product_list(page, campaign_id, access_token):
             }
         }
     """
-    endpoint_url = "https://api.partner.market.yandex.ru/"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {access_token}",
-        "Accept": "application/json",
-        "Host": "api.partner.market.yandex.ru",
-    }
+    if client is None:
+        client = get_client(access_token)
     payload = {
         "page_token": page,
         "limit": 200,
     }
-    url = endpoint_url + f"campaigns/{campaign_id}/offer-mapping-entries"
-    response = requests.get(url, headers=headers, params=payload)
-    response.raise_for_status()
-    response_object = response.json()
+    url = f"campaigns/{campaign_id}/offer-mapping-entries"
+    response_object = client.get(
+        url, endpoint="offer-mapping-entries", account=campaign_id, params=payload
+    )
     return response_object.get("result")
 
 
-def update_stocks(stocks, campaign_id, access_token):
+def update_stocks(stocks, campaign_id, access_token, client=None):
     """Обновить остатки.
 
     Обновляет на Яндекс Маркете информацию о количестве товаров.
@@ -156,6 +195,8 @@ def update_stocks(stocks, campaign_id, access_token):
         campaign_id (str): Идентификатор кампании и идентификатор магазина
         Яндекс Маркета.
         access_token (str): API-токен продавца Яндекс Маркета.
+        client (ApiClient): Клиент API Яндекс Маркета. Если не задан,
+        используется общий клиент токена, см. get_client.
 
     Returns:
         response_object (dict): Ответ Яндекс Маркета Ozon в формате json об
@@ -181,22 +222,18 @@ def update_stocks(stocks, campaign_id, access_token):
             ]
         }
     """
-    endpoint_url = "https://api.partner.market.yandex.ru/"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {access_token}",
-        "Accept": "application/json",
-        "Host": "api.partner.market.yandex.ru",
-    }
-    payload = {"skus": stocks}
-    url = endpoint_url + f"campaigns/{campaign_id}/offers/stocks"
-    response = requests.put(url, headers=headers, json=payload)
-    response.raise_for_status()
-    response_object = response.json()
-    return response_object
+    if client is None:
+        client = get_client(access_token)
+    url = f"campaigns/{campaign_id}/offers/stocks"
+    return client.put(
+        url,
+        endpoint="offers/stocks",
+        account=campaign_id,
+        data=payloads.encode("skus", stocks),
+    )
 
 
-def update_price(prices, campaign_id, access_token):
+def update_price(prices, campaign_id, access_token, client=None):
     """Обновить цены товаров.
 
     Обновляет на Яндекс Маркете информацию о стоимости остатков.
@@ -206,6 +243,8 @@ def update_price(prices, campaign_id, access_token):
         campaign_id (str): Идентификатор кампании и идентификатор магазина
         Яндекс Маркета.
         access_token (str): API-токен продавца Яндекс Маркета.
+        client (ApiClient): Клиент API Яндекс Маркета. Если не задан,
+        используется общий клиент токена, см. get_client.
 
     Returns:
         response_object (dict): Ответ Яндекс Маркета в формате json об
@@ -231,30 +270,43 @@ def update_price(prices, campaign_id, access_token):
             ]
         }
     """
-    endpoint_url = "https://api.partner.market.yandex.ru/"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {access_token}",
-        "Accept": "application/json",
-        "Host": "api.partner.market.yandex.ru",
-    }
-    payload = {"offers": prices}
-    url = endpoint_url + f"campaigns/{campaign_id}/offer-prices/updates"
-    response = requests.post(url, headers=headers, json=payload)
-    response.raise_for_status()
-    response_object = response.json()
-    return response_object
+    if client is None:
+        client = get_client(access_token)
+    url = f"campaigns/{campaign_id}/offer-prices/updates"
+    return client.post(
+        url,
+        endpoint="offer-prices/updates",
+        account=campaign_id,
+        data=payloads.encode("offers", prices),
+    )
 
 
-def get_offer_ids(campaign_id, market_token):
+def get_offer_ids(
+    campaign_id,
+    market_token,
+    catalog_path=None,
+    catalog_ttl=catalog.CATALOG_TTL,
+    refresh=False,
+    context=None,
+    client=None,
+):
     """Получить артикулы товаров Яндекс Маркета.
 
     Постранично запрашивает артикулы созданных товаров у Яндекс Маркета.
+    Если задан catalog_path, артикулы берутся из локальной базы, пока не
+    устареют.
 
     Args:
         campaign_id (str): Идентификатор кампании и идентификатор магазина
         Яндекс Маркета.
         market_token (str): API-токен продавца Яндекс Маркета.
+        catalog_path (str): Путь к базе артикулов SQLite.
+        catalog_ttl (float): Срок актуальности артикулов в базе в секундах.
+        refresh (bool): Запросить артикулы у Яндекс Маркета, даже если в
+        базе есть актуальные.
+        context (CatalogContext): Артикулы, уже полученные за этот запуск.
+        Если задан, каждая кампания запрашивается не больше одного раза.
+        client (ApiClient): Клиент API Яндекс Маркета, см. get_client.
 
     Returns:
         offer_ids (list): Список артикулов товаров Яндекс Маркета.
@@ -266,28 +318,98 @@ def get_offer_ids(campaign_id, market_token):
         >>> get_offer_ids(campaign_id, market_token)
         ["136748", "168448", "528148", "236297"]
     """
+    account = f"yandex:{campaign_id}"
+    if context is not None:
+        return context.get_offer_ids(
+            account,
+            functools.partial(
+                get_offer_ids,
+                campaign_id,
+                market_token,
+                catalog_path=catalog_path,
+                catalog_ttl=catalog_ttl,
+                refresh=refresh,
+                client=client,
+            ),
+        )
+    if catalog_path:
+        return catalog.cached_offer_ids(
+            catalog_path,
+            account,
+            functools.partial(
+                get_offer_ids, campaign_id, market_token, client=client
+            ),
+            ttl=catalog_ttl,
+            refresh=refresh,
+        )
+    return list(iter_offer_ids(campaign_id, market_token, client))
+
+
+def iter_offer_ids(campaign_id, market_token, client=None):
+    """Перебрать артикулы товаров Яндекс Маркета по мере получения страниц.
+
+    Args:
+        campaign_id (str): Идентификатор кампании и идентификатор магазина
+        Яндекс Маркета.
+        market_token (str): API-токен продавца Яндекс Маркета.
+        client (ApiClient): Клиент API Яндекс Маркета, см. get_client.
+
+    Yields:
+        str: Артикул товара Яндекс Маркета.
+
+    Raises:
+        HTTPError: Если код ответа не 200.
+    """
+    for page in iter_offer_id_pages(campaign_id, market_token, client):
+        yield from page
+
+
+def iter_offer_id_pages(campaign_id, market_token, client=None):
+    """Постранично запрашивать артикулы товаров Яндекс Маркета.
+
+    Следующая страница запрашивается, только когда обработана предыдущая,
+    поэтому сопоставление с остатками и выгрузка могут начинаться с первой
+    страницы. Чтобы запрашивать следующую страницу во время обработки
+    текущей, оберните генератор в catalog.prefetch.
+
+    Args:
+        campaign_id (str): Идентификатор кампании и идентификатор магазина
+        Яндекс Маркета.
+        market_token (str): API-токен продавца Яндекс Маркета.
+        client (ApiClient): Клиент API Яндекс Маркета, см. get_client.
+
+    Yields:
+        list: Артикулы товаров Яндекс Маркета с одной страницы.
+
+    Raises:
+        HTTPError: Если код ответа не 200.
+
+    Examples:
+        >>> list(iter_offer_id_pages(campaign_id, market_token))
+        [["136748", "168448"], ["528148", "236297"]]
+    """
     page = ""
-    product_list = []
     while True:
-        some_prod = get_product_list(page, campaign_id, market_token)
-        product_list.extend(some_prod.get("offerMappingEntries"))
+        some_prod = get_product_list(page, campaign_id, market_token, client)
+        yield [
+            product.get("offer").get("shopSku")
+            for product in some_prod.get("offerMappingEntries")
+        ]
         page = some_prod.get("paging").get("nextPageToken")
         if not page:
             break
-    offer_ids = []
-    for product in product_list:
-        offer_ids.append(product.get("offer").get("shopSku"))
-    return offer_ids
 
 
 def create_stocks(watch_remnants, offer_ids, warehouse_id):
     """Сформировать список товаров в наличии и их количества.
 
     На основании данных с сайта timeworld.ru заполняет информацию об
-    остатках для Яндекс Маркета.
+    остатках для Яндекс Маркета. Товары, количество которых не удалось разобрать,
+    пропускаются.
 
     Args:
-        watch_remnants (list): Список словарей с информацией о товарах.
+        watch_remnants (list | OfferTable): Список словарей с информацией
+        о товарах или таблица предложений.
         offer_ids (list): Список артикулов товаров Яндекс Маркета.
         warehouse_id (str): ID склада.
 
@@ -321,58 +443,21 @@ def create_stocks(watch_remnants, offer_ids, warehouse_id):
             }
         ]
     """
-    # Уберем то, что не загружено в market
-    stocks = list()
-    date = str(datetime.datetime.utcnow().replace(microsecond=0).isoformat() + "Z")
-    for watch in watch_remnants:
-        if str(watch.get("Код")) in offer_ids:
-            count = str(watch.get("Количество"))
-            if count == ">10":
-                stock = 100
-            elif count == "1":
-                stock = 0
-            else:
-                stock = int(watch.get("Количество"))
-            stocks.append(
-                {
-                    "sku": str(watch.get("Код")),
-                    "warehouseId": warehouse_id,
-                    "items": [
-                        {
-                            "count": stock,
-                            "type": "FIT",
-                            "updatedAt": date,
-                        }
-                    ],
-                }
-            )
-            offer_ids.remove(str(watch.get("Код")))
-    # Добавим недостающее из загруженного:
-    for offer_id in offer_ids:
-        stocks.append(
-            {
-                "sku": offer_id,
-                "warehouseId": warehouse_id,
-                "items": [
-                    {
-                        "count": 0,
-                        "type": "FIT",
-                        "updatedAt": date,
-                    }
-                ],
-            }
-        )
-    return stocks
+    return list(
+        iter_stocks(OfferTable.from_remnants(watch_remnants), offer_ids, warehouse_id)
+    )
 
 
 def create_prices(watch_remnants, offer_ids):
     """Обновление цен товаров.
 
     На основании данных с сайта timeworld.ru заполняет информацию о новых
-    ценах для Яндекс Маркета.
+    ценах для Яндекс Маркета. Товары, цену которых не удалось разобрать,
+    пропускаются.
 
     Args:
-        watch_remnants (list): Список словарей с информацией о товарах.
+        watch_remnants (list | OfferTable): Список словарей с информацией
+        о товарах или таблица предложений.
         offer_ids (list): Список артикулов товаров Яндекс Маркета.
 
     Returns:
@@ -391,45 +476,347 @@ def create_prices(watch_remnants, offer_ids):
         ]
 
     """
-    prices = []
-    for watch in watch_remnants:
-        if str(watch.get("Код")) in offer_ids:
-            price = {
-                "id": str(watch.get("Код")),
-                # "feed": {"id": 0},
-                "price": {
-                    "value": int(price_conversion(watch.get("Цена"))),
-                    # "discountBase": 0,
-                    "currencyId": "RUR",
-                    # "vat": 0,
-                },
-                # "marketSku": 0,
-                # "shopSku": "string",
+    return list(iter_prices(OfferTable.from_remnants(watch_remnants), offer_ids))
+
+
+def iter_stocks(offer_table, offer_ids, warehouse_id):
+    """Перебрать остатки товаров в формате Яндекс Маркета.
+
+    Args:
+        offer_table (OfferTable): Таблица предложений.
+        offer_ids (list): Список артикулов товаров Яндекс Маркета.
+        warehouse_id (str): ID склада.
+
+    Yields:
+        dict: Количество товара для campaigns/{campaignId}/offers/stocks.
+    """
+    date = str(datetime.datetime.utcnow().replace(microsecond=0).isoformat() + "Z")
+    # Уберем то, что не загружено в market, и добавим недостающее
+    for sku, stock in offer_table.stock_rows(offer_ids):
+        yield {
+            "sku": sku,
+            "warehouseId": warehouse_id,
+            "items": [
+                {
+                    "count": stock,
+                    "type": "FIT",
+                    "updatedAt": date,
+                }
+            ],
+        }
+
+
+def iter_prices(offer_table, offer_ids):
+    """Перебрать цены товаров в формате Яндекс Маркета.
+
+    Args:
+        offer_table (OfferTable): Таблица предложений.
+        offer_ids (list): Список артикулов товаров Яндекс Маркета.
+
+    Yields:
+        dict: Цена товара для campaigns/{campaignId}/offer-prices/updates.
+    """
+    for sku, price in offer_table.price_rows(offer_ids):
+        yield {
+            "id": sku,
+            # "feed": {"id": 0},
+            "price": {
+                "value": price,
+                # "discountBase": 0,
+                "currencyId": "RUR",
+                # "vat": 0,
+            },
+            # "marketSku": 0,
+            # "shopSku": "string",
+        }
+
+
+def render_stocks(
+    offer_table,
+    offer_ids,
+    warehouse_id,
+    batch_size=STOCKS_BATCH_SIZE,
+    max_bytes=BATCH_MAX_BYTES,
+):
+    """Сформировать остатки для Яндекс Маркета частями по мере выгрузки.
+
+    Args:
+        offer_table (OfferTable): Таблица предложений.
+        offer_ids (list): Список артикулов товаров Яндекс Маркета.
+        warehouse_id (str): ID склада.
+        batch_size (int): Максимальное количество товаров в части.
+        max_bytes (int): Максимальный размер части в JSON.
+
+    Returns:
+        Генератор списков обновленного количества товаров.
+    """
+    return batched(
+        iter_stocks(offer_table, offer_ids, warehouse_id), batch_size, max_bytes
+    )
+
+
+def render_prices(
+    offer_table,
+    offer_ids,
+    batch_size=PRICES_BATCH_SIZE,
+    max_bytes=BATCH_MAX_BYTES,
+):
+    """Сформировать цены для Яндекс Маркета частями по мере выгрузки.
+
+    Args:
+        offer_table (OfferTable): Таблица предложений.
+        offer_ids (list): Список артикулов товаров Яндекс Маркета.
+        batch_size (int): Максимальное количество товаров в части.
+        max_bytes (int): Максимальный размер части в JSON.
+
+    Returns:
+        Генератор списков новых цен товаров.
+    """
+    return batched(iter_prices(offer_table, offer_ids), batch_size, max_bytes)
+
+
+def render_warehouse_stocks(
+    offer_table,
+    targets,
+    catalogs,
+    batch_size=STOCKS_BATCH_SIZE,
+    max_bytes=BATCH_MAX_BYTES,
+):
+    """Сформировать остатки сразу для нескольких складов.
+
+    Количество товаров берется из общей таблицы предложений, время
+    обновления вычисляется один раз, а сопоставление с артикулами
+    выполняется один раз на кампанию, даже если у нее несколько складов.
+    Для каждого склада остается только сформировать данные.
+
+    Args:
+        offer_table (OfferTable): Таблица предложений.
+        targets (list): Пары (идентификатор кампании, ID склада).
+        catalogs (dict): Списки артикулов товаров по идентификаторам
+        кампаний.
+        batch_size (int): Максимальное количество товаров в части.
+        max_bytes (int): Максимальный размер части в JSON.
+
+    Yields:
+        tuple: Идентификатор кампании, ID склада и часть списка
+        обновленного количества товаров.
+
+    Examples:
+        >>> next(render_warehouse_stocks(
+        ...     offer_table,
+        ...     [(campaign_fbs_id, warehouse_fbs_id), (campaign_fbs_id, "143646")],
+        ...     {campaign_fbs_id: fbs_offer_ids},
+        ... ))
+        (
+            "21432232",
+            "143645",
+            [
+                {
+                    "sku": "48852",
+                    "warehouseId": "143645",
+                    "items": [
+                        {
+                            "count": 0,
+                            "type": "FIT",
+                            "updatedAt": "2023-08-13T19:50:21Z",
+                        }
+                    ],
+                }
+            ]
+        )
+    """
+    date = str(datetime.datetime.utcnow().replace(microsecond=0).isoformat() + "Z")
+    stock_rows = {}
+    for campaign_id, warehouse_id in targets:
+        if campaign_id not in stock_rows:
+            stock_rows[campaign_id] = list(
+                offer_table.stock_rows(catalogs[campaign_id])
+            )
+        warehouse_stocks = (
+            {
+                "sku": sku,
+                "warehouseId": warehouse_id,
+                "items": [
+                    {
+                        "count": stock,
+                        "type": "FIT",
+                        "updatedAt": date,
+                    }
+                ],
             }
-            prices.append(price)
-    return prices
+            for sku, stock in stock_rows[campaign_id]
+        )
+        for some_stock in batched(warehouse_stocks, batch_size, max_bytes):
+            yield campaign_id, warehouse_id, some_stock
+
+
+def _skip_invalid_offers(cache_dir, campaign_id, offer_ids):
+    # Товары, отклоненные без права повтора, не выгружаются
+    if not cache_dir:
+        return offer_ids
+    invalid_offers = feed_cache.load_invalid_offers(cache_dir, f"yandex_{campaign_id}")
+    return [sku for sku in offer_ids if sku not in invalid_offers]
+
 
+def _save_invalid_offers(cache_dir, campaign_id, invalid):
+    if cache_dir and invalid:
+        feed_cache.save_invalid_offers(cache_dir, f"yandex_{campaign_id}", invalid)
 
-async def upload_prices(watch_remnants, campaign_id, market_token):
+
+def update_warehouses(
+    watch_remnants,
+    targets,
+    market_token,
+    client=None,
+    concurrency=http_client.UPLOAD_CONCURRENCY,
+    retry_budget=None,
+    cache_dir=None,
+    **catalog_options,
+):
+    """Обновить остатки на нескольких складах и цены их кампаний.
+
+    Остатки всех складов формируются из общей таблицы предложений, см.
+    render_warehouse_stocks. Цены обновляются один раз на кампанию. Части
+    списков отправляются в пуле потоков, см. dispatcher.dispatch_batches.
+    Товары, которые Яндекс Маркет не обновил, отправляются снова, см.
+    dispatcher.resubmit_failed.
+
+    Args:
+        watch_remnants (list | OfferTable): Список словарей с информацией
+        о товарах или таблица предложений.
+        targets (list): Пары (идентификатор кампании, ID склада).
+        market_token (str): API-токен продавца Яндекс Маркета.
+        client (ApiClient): Клиент API Яндекс Маркета, см. get_client.
+        concurrency (int): Сколько частей отправляется одновременно.
+        retry_budget (RetryBudget): Бюджет повторов запуска.
+        cache_dir (str): Директория кэша фида для отклоненных товаров.
+        **catalog_options: Настройки получения артикулов, см. get_offer_ids.
+
+    Returns:
+        stocks (dict): Списки обновленного количества товаров по парам
+        (идентификатор кампании, ID склада).
+        prices (dict): Списки новых цен товаров по кампаниям.
+
+    Raises:
+        DispatchError: Если часть списка не удалось отправить.
+    """
+    offer_table = OfferTable.from_remnants(watch_remnants)
+    if retry_budget is None:
+        retry_budget = retry.RetryBudget()
+    catalogs = {}
+    invalid = {}
+    for campaign_id, _ in targets:
+        if campaign_id not in catalogs:
+            offer_ids = get_offer_ids(
+                campaign_id, market_token, client=client, **catalog_options
+            )
+            invalid[campaign_id] = {}
+            catalogs[campaign_id] = _skip_invalid_offers(
+                cache_dir, campaign_id, offer_ids
+            )
+    dispatches = []
+    stocks = {target: [] for target in targets}
+    warehouse_batches = itertools.groupby(
+        render_warehouse_stocks(offer_table, targets, catalogs),
+        key=lambda warehouse_batch: warehouse_batch[:2],
+    )
+    for (campaign_id, warehouse_id), group in warehouse_batches:
+        upload_stocks_batch = functools.partial(
+            update_stocks,
+            campaign_id=campaign_id,
+            access_token=market_token,
+            client=client,
+        )
+        dispatch = dispatcher.dispatch_batches(
+            (some_stock for _, _, some_stock in group),
+            upload_stocks_batch,
+            concurrency,
+            f"Яндекс Маркет {campaign_id}, склад {warehouse_id}: остатки",
+            retry_budget,
+        )
+        resubmit = dispatcher.resubmit_failed(
+            dispatch,
+            upload_stocks_batch,
+            responses.yandex_errors,
+            "sku",
+            functools.partial(batched, n=STOCKS_BATCH_SIZE, max_bytes=BATCH_MAX_BYTES),
+            concurrency,
+            retry_budget,
+        )
+        dispatches += [dispatch, resubmit.dispatch]
+        invalid[campaign_id].update(resubmit.invalid)
+        stocks[campaign_id, warehouse_id] = resubmit.accepted
+    prices = {}
+    for campaign_id, offer_ids in catalogs.items():
+        upload_prices_batch = functools.partial(
+            update_price,
+            campaign_id=campaign_id,
+            access_token=market_token,
+            client=client,
+        )
+        dispatch = dispatcher.dispatch_batches(
+            render_prices(offer_table, offer_ids),
+            upload_prices_batch,
+            concurrency,
+            f"Яндекс Маркет {campaign_id}: цены",
+            retry_budget,
+        )
+        resubmit = dispatcher.resubmit_failed(
+            dispatch,
+            upload_prices_batch,
+            responses.yandex_errors,
+            "id",
+            functools.partial(batched, n=PRICES_BATCH_SIZE, max_bytes=BATCH_MAX_BYTES),
+            concurrency,
+            retry_budget,
+        )
+        dispatches += [dispatch, resubmit.dispatch]
+        invalid[campaign_id].update(resubmit.invalid)
+        prices[campaign_id] = resubmit.accepted
+    for campaign_id, campaign_invalid in invalid.items():
+        _save_invalid_offers(cache_dir, campaign_id, campaign_invalid)
+    dispatcher.raise_for_errors(*dispatches)
+    return stocks, prices
+
+
+async def upload_prices(
+    watch_remnants,
+    campaign_id,
+    market_token,
+    context=None,
+    client=None,
+    concurrency=http_client.UPLOAD_CONCURRENCY,
+    retry_budget=None,
+    cache_dir=None,
+):
     """Загрузить список цен на Яндекс Маркет.
 
     Обновляет цены товаров на Яндекс Маркет в соответствии с полученными в
-    watch_remnants данными.
+    watch_remnants данными. Части списка отправляются одновременно, но
+    не больше concurrency за раз. Товары, которые Яндекс Маркет не
+    обновил, отправляются снова, как и в update_remnants.
 
     Args:
-        watch_remnants (list): Список словарей с информацией о товарах.
+        watch_remnants (list | OfferTable): Список словарей с информацией
+        о товарах или таблица предложений.
         campaign_id (str): Идентификатор кампании и идентификатор магазина
         Яндекс Маркета.
         market_token (str): API-токен продавца Яндекс Маркета.
+        context (CatalogContext): Артикулы, уже полученные за этот запуск.
+        client (ApiClient): Клиент API Яндекс Маркета, см. get_client.
+        concurrency (int): Сколько частей отправляется одновременно.
+        retry_budget (RetryBudget): Бюджет повторов запуска.
+        cache_dir (str): Директория кэша фида для отклоненных товаров.
 
     Returns:
-        prices (list): Список новых цен товаров.
+        prices (list): Список новых цен товаров, принятых Яндекс Маркетом.
 
     Raises:
-        HTTPError: Если код ответа не 200.
+        HTTPError: Если код ответа не 200 при запросе артикулов.
+        DispatchError: Если часть списка не удалось отправить.
 
     Examples:
-        >>> upload_prices(watch_remnants, campaign_id, market_token)
+        >>> await upload_prices(watch_remnants, campaign_id, market_token)
         [
             {
                 "id": "48852",
@@ -440,36 +827,84 @@ async def upload_prices(watch_remnants, campaign_id, market_token):
             }
         ]
     """
-    offer_ids = get_offer_ids(campaign_id, market_token)
+    if client is None:
+        client = get_client(market_token)
+    # Артикулы запрашиваются синхронно, поэтому в отдельном потоке
+    offer_ids = await asyncio.to_thread(
+        get_offer_ids, campaign_id, market_token, context=context, client=client
+    )
+    offer_ids = _skip_invalid_offers(cache_dir, campaign_id, offer_ids)
     prices = create_prices(watch_remnants, offer_ids)
-    for some_prices in list(divide(prices, 500)):
-        update_price(some_prices, campaign_id, market_token)
-    return prices
-
-
-async def upload_stocks(watch_remnants, campaign_id, market_token, warehouse_id):
+    rebatch = functools.partial(batched, n=PRICES_BATCH_SIZE, max_bytes=BATCH_MAX_BYTES)
+    async with http_client.AsyncApiClient(client, concurrency) as async_client:
+        upload = functools.partial(
+            async_client.send_batch,
+            "POST",
+            f"campaigns/{campaign_id}/offer-prices/updates",
+            "offers",
+            endpoint="offer-prices/updates",
+            account=campaign_id,
+        )
+        dispatch = await dispatcher.dispatch_batches_async(
+            rebatch(prices),
+            upload,
+            f"Яндекс Маркет {campaign_id}: цены",
+            retry_budget,
+        )
+        resubmit = await dispatcher.resubmit_failed_async(
+            dispatch, upload, responses.yandex_errors, "id", rebatch, retry_budget
+        )
+    _save_invalid_offers(cache_dir, campaign_id, resubmit.invalid)
+    dispatcher.raise_for_errors(dispatch, resubmit.dispatch)
+    return resubmit.accepted
+
+
+async def upload_stocks(
+    watch_remnants,
+    campaign_id,
+    market_token,
+    warehouse_id,
+    context=None,
+    client=None,
+    concurrency=http_client.UPLOAD_CONCURRENCY,
+    retry_budget=None,
+    cache_dir=None,
+):
     """Загрузить количество товаров на Яндекс Маркет.
 
     Обновляет количество товаров на Яндекс Маркет в соответствии с
     полученными в watch_remnants данными. Формирует отдельным списком
-    товары, которые есть в наличии.
+    товары, которые есть в наличии. Части списка отправляются
+    одновременно, но не больше concurrency за раз. Товары, которые
+    Яндекс Маркет не обновил, отправляются снова, как и в
+    update_remnants.
 
     Args:
-        watch_remnants (list): Список словарей с информацией о товарах.
+        watch_remnants (list | OfferTable): Список словарей с информацией
+        о товарах или таблица предложений.
         campaign_id (str): Идентификатор кампании и идентификатор магазина
         Яндекс Маркета.
         market_token (str): API-токен продавца Яндекс Маркета.
         warehouse_id (): ID склада.
+        context (CatalogContext): Артикулы, уже полученные за этот запуск.
+        client (ApiClient): Клиент API Яндекс Маркета, см. get_client.
+        concurrency (int): Сколько частей отправляется одновременно.
+        retry_budget (RetryBudget): Бюджет повторов запуска.
+        cache_dir (str): Директория кэша фида для отклоненных товаров.
 
     Returns:
         not_empty (list): Список товаров, которые есть в наличии.
-        stocks (list): Список обновленного количества товаров.
+        stocks (list): Список обновленного количества товаров, принятых
+        Яндекс Маркетом.
 
     Raises:
-        HTTPError: Если код ответа не 200.
+        HTTPError: Если код ответа не 200 при запросе артикулов.
+        DispatchError: Если часть списка не удалось отправить.
 
     Examples:
-        >>> upload_stocks(watch_remnants, campaign_id, market_token, warehouse_id)
+        >>> await upload_stocks(
+        ...     watch_remnants, campaign_id, market_token, warehouse_id
+        ... )
         [
             {
                 "sku": "48857",
@@ -508,43 +943,349 @@ async def upload_stocks(watch_remnants, campaign_id, market_token, warehouse_id)
             }
         ]
     """
-    offer_ids = get_offer_ids(campaign_id, market_token)
+    if client is None:
+        client = get_client(market_token)
+    # Артикулы запрашиваются синхронно, поэтому в отдельном потоке
+    offer_ids = await asyncio.to_thread(
+        get_offer_ids, campaign_id, market_token, context=context, client=client
+    )
+    offer_ids = _skip_invalid_offers(cache_dir, campaign_id, offer_ids)
     stocks = create_stocks(watch_remnants, offer_ids, warehouse_id)
-    for some_stock in list(divide(stocks, 2000)):
-        update_stocks(some_stock, campaign_id, market_token)
+    rebatch = functools.partial(batched, n=STOCKS_BATCH_SIZE, max_bytes=BATCH_MAX_BYTES)
+    async with http_client.AsyncApiClient(client, concurrency) as async_client:
+        upload = functools.partial(
+            async_client.send_batch,
+            "PUT",
+            f"campaigns/{campaign_id}/offers/stocks",
+            "skus",
+            endpoint="offers/stocks",
+            account=campaign_id,
+        )
+        dispatch = await dispatcher.dispatch_batches_async(
+            rebatch(stocks),
+            upload,
+            f"Яндекс Маркет {campaign_id}, склад {warehouse_id}: остатки",
+            retry_budget,
+        )
+        resubmit = await dispatcher.resubmit_failed_async(
+            dispatch, upload, responses.yandex_errors, "sku", rebatch, retry_budget
+        )
+    _save_invalid_offers(cache_dir, campaign_id, resubmit.invalid)
+    dispatcher.raise_for_errors(dispatch, resubmit.dispatch)
+    stocks = resubmit.accepted
     not_empty = list(
         filter(lambda stock: (stock.get("items")[0].get("count") != 0), stocks)
     )
     return not_empty, stocks
 
 
+def upload_remnants(
+    watch_remnants,
+    campaign_id,
+    market_token,
+    warehouse_id,
+    context=None,
+    client=None,
+    concurrency=http_client.UPLOAD_CONCURRENCY,
+    retry_budget=None,
+    cache_dir=None,
+):
+    """Загрузить количество и цены товаров на Яндекс Маркет из синхронного кода.
+
+    Запускает upload_stocks и upload_prices одновременно в новом цикле
+    событий, например из main при UPLOAD_MODE=async. Нужен aiohttp.
+    Ошибка одной выгрузки сообщается после завершения обеих.
+
+    Args:
+        watch_remnants (list | OfferTable): Список словарей с информацией
+        о товарах или таблица предложений.
+        campaign_id (str): Идентификатор кампании и идентификатор магазина
+        Яндекс Маркета.
+        market_token (str): API-токен продавца Яндекс Маркета.
+        warehouse_id (str): ID склада.
+        context (CatalogContext): Артикулы, уже полученные за этот запуск.
+        client (ApiClient): Клиент API Яндекс Маркета, см. get_client.
+        concurrency (int): Сколько частей отправляется одновременно.
+        retry_budget (RetryBudget): Бюджет повторов запуска.
+        cache_dir (str): Директория кэша фида для отклоненных товаров.
+
+    Returns:
+        stocks (list): Список обновленного количества товаров, принятых
+        Яндекс Маркетом.
+        prices (list): Список новых цен товаров, принятых Яндекс Маркетом.
+
+    Raises:
+        HTTPError: Если код ответа не 200 при запросе артикулов.
+        DispatchError: Если часть списка не удалось отправить.
+    """
+    offer_table = OfferTable.from_remnants(watch_remnants)
+    if retry_budget is None:
+        retry_budget = retry.RetryBudget()
+    if context is None:
+        context = catalog.CatalogContext()
+
+    async def upload():
+        return await asyncio.gather(
+            upload_stocks(
+                offer_table,
+                campaign_id,
+                market_token,
+                warehouse_id,
+                context,
+                client,
+                concurrency,
+                retry_budget,
+                cache_dir,
+            ),
+            upload_prices(
+                offer_table,
+                campaign_id,
+                market_token,
+                context,
+                client,
+                concurrency,
+                retry_budget,
+                cache_dir,
+            ),
+            return_exceptions=True,
+        )
+
+    results = asyncio.run(upload())
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    (_, stocks), prices = results
+    return stocks, prices
+
+
+def update_remnants(
+    watch_remnants,
+    campaign_id,
+    market_token,
+    warehouse_id,
+    cache_dir=None,
+    changed_only=False,
+    full_sync_interval=feed_cache.FULL_SYNC_INTERVAL,
+    offer_ids=None,
+    context=None,
+    client=None,
+    concurrency=http_client.UPLOAD_CONCURRENCY,
+    retry_budget=None,
+):
+    """Обновить остатки и цены товаров кампании Яндекс Маркета.
+
+    Части списков отправляются в пуле потоков, см.
+    dispatcher.dispatch_batches. Если часть не удалось отправить,
+    остальные все равно отправляются, а ошибка сообщается в конце.
+    Товары, которые Яндекс Маркет не обновил, отправляются снова
+    отдельными частями, см. dispatcher.resubmit_failed. Если задан
+    cache_dir, товары, отклоненные без права повтора, сохраняются и не
+    выгружаются feed_cache.INVALID_OFFER_TTL секунд.
+
+    Args:
+        watch_remnants (list | OfferTable): Список словарей с информацией
+        о товарах или таблица предложений.
+        campaign_id (str): Идентификатор кампании и идентификатор магазина
+        Яндекс Маркета.
+        market_token (str): API-токен продавца Яндекс Маркета.
+        warehouse_id (str): ID склада.
+        cache_dir (str): Директория кэша фида для снимка выгруженных
+        остатков и отклоненных товаров.
+        changed_only (bool): Выгружать только товары, изменившиеся с
+        прошлого запуска. Работает, только если задан cache_dir.
+        full_sync_interval (float): Период полной выгрузки всех товаров в
+        секундах при changed_only.
+        offer_ids (list): Уже полученный список артикулов товаров кампании.
+        Если не задан, запрашивается у Яндекс Маркета.
+        context (CatalogContext): Артикулы, уже полученные за этот запуск.
+        client (ApiClient): Клиент API Яндекс Маркета, см. get_client.
+        concurrency (int): Сколько частей отправляется одновременно.
+        retry_budget (RetryBudget): Бюджет повторов запуска.
+
+    Returns:
+        stocks (list): Список обновленного количества товаров.
+        prices (list): Список новых цен товаров.
+
+    Raises:
+        DispatchError: Если часть списка не удалось отправить.
+    """
+    if offer_ids is None:
+        offer_ids = get_offer_ids(
+            campaign_id, market_token, context=context, client=client
+        )
+    offer_table = OfferTable.from_remnants(watch_remnants)
+    if retry_budget is None:
+        retry_budget = retry.RetryBudget()
+    stock_ids = price_ids = _skip_invalid_offers(cache_dir, campaign_id, offer_ids)
+    plan = None
+    if cache_dir and changed_only:
+        snapshot_name = f"yandex_{campaign_id}_{warehouse_id}"
+        plan = feed_cache.plan_sync(
+            cache_dir, snapshot_name, offer_table, full_sync_interval
+        )
+        if plan.stock_skus is not None:
+            stock_ids = [sku for sku in stock_ids if sku in plan.stock_skus]
+            price_ids = [sku for sku in price_ids if sku in plan.price_skus]
+    # Обновить остатки
+    upload_stocks_batch = functools.partial(
+        update_stocks,
+        campaign_id=campaign_id,
+        access_token=market_token,
+        client=client,
+    )
+    stocks = dispatcher.dispatch_batches(
+        render_stocks(offer_table, stock_ids, warehouse_id),
+        upload_stocks_batch,
+        concurrency,
+        f"Яндекс Маркет {campaign_id}, склад {warehouse_id}: остатки",
+        retry_budget,
+    )
+    stocks_retry = dispatcher.resubmit_failed(
+        stocks,
+        upload_stocks_batch,
+        responses.yandex_errors,
+        "sku",
+        functools.partial(batched, n=STOCKS_BATCH_SIZE, max_bytes=BATCH_MAX_BYTES),
+        concurrency,
+        retry_budget,
+    )
+    # Поменять цены
+    upload_prices_batch = functools.partial(
+        update_price,
+        campaign_id=campaign_id,
+        access_token=market_token,
+        client=client,
+    )
+    prices = dispatcher.dispatch_batches(
+        render_prices(offer_table, price_ids),
+        upload_prices_batch,
+        concurrency,
+        f"Яндекс Маркет {campaign_id}: цены",
+        retry_budget,
+    )
+    prices_retry = dispatcher.resubmit_failed(
+        prices,
+        upload_prices_batch,
+        responses.yandex_errors,
+        "id",
+        functools.partial(batched, n=PRICES_BATCH_SIZE, max_bytes=BATCH_MAX_BYTES),
+        concurrency,
+        retry_budget,
+    )
+    _save_invalid_offers(
+        cache_dir, campaign_id, {**stocks_retry.invalid, **prices_retry.invalid}
+    )
+    dispatcher.raise_for_errors(
+        stocks, stocks_retry.dispatch, prices, prices_retry.dispatch
+    )
+    # Не принятые товары должны попасть в следующую выгрузку изменений
+    if plan and not (stocks_retry.failed or prices_retry.failed):
+        feed_cache.save_snapshot(
+            cache_dir, snapshot_name, plan.snapshot, plan.full_sync_at
+        )
+    return stocks_retry.accepted, prices_retry.accepted
+
+
 def main():
     env = Env()
+    logging.basicConfig(
+        level=env.str("LOG_LEVEL", "INFO"),
+        format="%(asctime)s %(levelname)s %(message)s",
+    )
     market_token = env.str("MARKET_TOKEN")
     campaign_fbs_id = env.str("FBS_ID")
     campaign_dbs_id = env.str("DBS_ID")
     warehouse_fbs_id = env.str("WAREHOUSE_FBS_ID")
     warehouse_dbs_id = env.str("WAREHOUSE_DBS_ID")
+    feed_cache_dir = env.str("FEED_CACHE_DIR", None)
+    changed_only = env.bool("CHANGED_ONLY", False)
+    full_sync_interval = env.float("FULL_SYNC_HOURS", 24) * 60 * 60
+    catalog_options = {
+        "catalog_path": env.str("CATALOG_CACHE", None),
+        "catalog_ttl": env.float("CATALOG_TTL_HOURS", 6) * 60 * 60,
+        "refresh": env.bool("CATALOG_REFRESH", False),
+        "context": catalog.CatalogContext(),
+    }
 
-    watch_remnants = download_stock()
+    concurrency = env.int("UPLOAD_CONCURRENCY", http_client.UPLOAD_CONCURRENCY)
+    rate_limit.LIMITER.configure(
+        rate_limit.parse_limits(env.dict("RATE_LIMITS", {}))
+    )
+    client = get_client(market_token, concurrency)
+    retry_budget = retry.RetryBudget(env.int("RETRY_BUDGET", retry.RETRY_BUDGET))
+    upload_mode = env.str("UPLOAD_MODE", "threads")
+    targets = [
+        (campaign_fbs_id, warehouse_fbs_id),
+        (campaign_dbs_id, warehouse_dbs_id),
+    ]
+
+    offer_table = OfferTable.from_remnants(download_stock(cache_dir=feed_cache_dir))
     try:
-        # FBS
-        offer_ids = get_offer_ids(campaign_fbs_id, market_token)
-        # Обновить остатки FBS
-        stocks = create_stocks(watch_remnants, offer_ids, warehouse_fbs_id)
-        for some_stock in list(divide(stocks, 2000)):
-            update_stocks(some_stock, campaign_fbs_id, market_token)
-        # Поменять цены FBS
-        upload_prices(watch_remnants, campaign_fbs_id, market_token)
-
-        # DBS
-        offer_ids = get_offer_ids(campaign_dbs_id, market_token)
-        # Обновить остатки DBS
-        stocks = create_stocks(watch_remnants, offer_ids, warehouse_dbs_id)
-        for some_stock in list(divide(stocks, 2000)):
-            update_stocks(some_stock, campaign_dbs_id, market_token)
-        # Поменять цены DBS
-        upload_prices(watch_remnants, campaign_dbs_id, market_token)
+        # Выгрузка изменений ведется только в пуле потоков
+        if upload_mode == "async" and not changed_only:
+            # Артикулы берутся из базы по настройкам каталога и попадают в
+            # контекст, откуда их берет upload_remnants
+            for campaign_id, _ in targets:
+                get_offer_ids(
+                    campaign_id, market_token, client=client, **catalog_options
+                )
+            # Как и в update_warehouses, ошибка склада не мешает выгрузке
+            # остальных
+            errors = []
+            for campaign_id, warehouse_id in targets:
+                try:
+                    upload_remnants(
+                        offer_table,
+                        campaign_id,
+                        market_token,
+                        warehouse_id,
+                        catalog_options["context"],
+                        client,
+                        concurrency,
+                        retry_budget,
+                        feed_cache_dir,
+                    )
+                except Exception as error:
+                    logger.error(
+                        "Яндекс Маркет %s, склад %s: %s",
+                        campaign_id,
+                        warehouse_id,
+                        error,
+                    )
+                    errors.append(error)
+            if errors:
+                raise errors[0]
+            return
+        if not changed_only:
+            update_warehouses(
+                offer_table,
+                targets,
+                market_token,
+                client,
+                concurrency,
+                retry_budget,
+                feed_cache_dir,
+                **catalog_options,
+            )
+            return
+        # Снимок выгруженных остатков ведется для каждого склада отдельно
+        for campaign_id, warehouse_id in targets:
+            offer_ids = get_offer_ids(
+                campaign_id, market_token, client=client, **catalog_options
+            )
+            update_remnants(
+                offer_table,
+                campaign_id,
+                market_token,
+                warehouse_id,
+                cache_dir=feed_cache_dir,
+                changed_only=changed_only,
+                full_sync_interval=full_sync_interval,
+                offer_ids=offer_ids,
+                client=client,
+                concurrency=concurrency,
+                retry_budget=retry_budget,
+            )
     except requests.exceptions.ReadTimeout:
         print("Превышено время ожидания...")
     except requests.exceptions.ConnectionError as error:
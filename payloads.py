@@ -0,0 +1,96 @@
+import json
+import logging.config
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__file__)
+
+JSON_CONTENT_TYPE = "application/json"
+
+
+def dumps_orjson(obj):
+    """Сериализовать объект в JSON через orjson.
+
+    Args:
+        obj: Словари, списки, строки и числа.
+
+    Returns:
+        bytes: JSON в кодировке UTF-8.
+    """
+    return orjson.dumps(obj)
+
+
+def dumps_stdlib(obj):
+    """Сериализовать объект в JSON стандартным модулем json.
+
+    Результат совпадает с orjson: без пробелов и без экранирования
+    кириллицы.
+
+    Args:
+        obj: Словари, списки, строки и числа.
+
+    Returns:
+        bytes: JSON в кодировке UTF-8.
+    """
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+SERIALIZERS = {
+    "orjson": dumps_orjson,
+    "json": dumps_stdlib,
+}
+# Быстрый orjson используется, если установлен
+BACKEND = "orjson" if orjson is not None else "json"
+dumps = SERIALIZERS[BACKEND]
+
+
+class EncodedBatch(list):
+    """Часть списка товаров вместе с JSON каждого товара.
+
+    Товары сериализуются один раз, когда часть собирается с ограничением
+    размера, и тело запроса склеивается из готовых байт, см. encode.
+    Список нельзя изменять после сборки, иначе JSON разойдется с ним.
+
+    Attributes:
+        encoded (list): JSON товаров в том же порядке.
+    """
+
+    def __init__(self, items=(), encoded=()):
+        super().__init__(items)
+        self.encoded = list(encoded)
+
+
+def encode(key, items):
+    """Сериализовать часть товаров в тело запроса к API площадки.
+
+    Если items - EncodedBatch, товары повторно не сериализуются.
+
+    Args:
+        key (str): Ключ списка в теле запроса, например "stocks".
+        items (list): Часть списка товаров.
+
+    Returns:
+        bytes: Тело запроса.
+
+    Examples:
+        >>> encode("stocks", [{"offer_id": "48852", "stock": 0}])
+        b'{"stocks":[{"offer_id":"48852","stock":0}]}'
+    """
+    if not isinstance(items, EncodedBatch):
+        return dumps({key: items})
+    return b"".join((b"{", dumps(key), b":[", b",".join(items.encoded), b"]}"))
+
+
+def json_headers(headers):
+    """Дополнить заголовки запроса для отправки тела в JSON.
+
+    Args:
+        headers (dict): Заголовки авторизации площадки.
+
+    Returns:
+        dict: Новый словарь заголовков с Content-Type.
+    """
+    return {**headers, "Content-Type": JSON_CONTENT_TYPE}
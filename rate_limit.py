@@ -0,0 +1,243 @@
+import asyncio
+import email.utils
+import logging.config
+import threading
+import time
+
+logger = logging.getLogger(__file__)
+
+# Запросов в секунду к одному методу API, если для него не задан лимит
+DEFAULT_RATE = 5
+# Лимиты площадок в запросах в секунду по (площадка, метод API)
+DEFAULT_LIMITS = {
+    ("ozon", "v2/product/list"): 5,
+    ("ozon", "v1/product/import/stocks"): 80 / 60,
+    ("ozon", "v1/product/import/prices"): 10,
+    ("yandex", "offer-mapping-entries"): 100 / 60,
+    ("yandex", "offers/stocks"): 50 / 60,
+    ("yandex", "offer-prices/updates"): 20 / 60,
+}
+# Коды ответа площадок о превышении лимита
+THROTTLE_STATUSES = (420, 429)
+# Пауза после превышения лимита без Retry-After и во сколько раз снижается
+# лимит, чтобы не превысить его снова
+THROTTLE_PAUSE = 1.0
+THROTTLE_FACTOR = 0.75
+MIN_RATE = 0.1
+
+
+class TokenBucket:
+    """Корзина токенов для одного метода API одного кабинета.
+
+    Токены накапливаются со скоростью rate в секунду, но не больше
+    capacity. Каждый запрос забирает токен, а если токенов нет, ждет
+    своей очереди. Очередь вычисляется под блокировкой, а ожидание идет
+    без нее, поэтому корзину можно использовать одновременно из потоков
+    и из asyncio.
+
+    Attributes:
+        rate (float): Запросов в секунду.
+        capacity (float): Сколько запросов можно сделать подряд без
+        ожидания.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Забрать токен.
+
+        Returns:
+            float: Сколько секунд ждать до отправки запроса.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._tokens -= 1
+            # Пока токенов меньше нуля, запрос ждет, когда долг накопится
+            return self._updated - now + max(0, -self._tokens) / self.rate
+
+    def _refill(self, now):
+        if now > self._updated:
+            elapsed = now - self._updated
+            self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+            self._updated = now
+
+    def pause(self, seconds):
+        """Не выдавать токены seconds секунд.
+
+        Args:
+            seconds (float): Длительность паузы.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            until = now + seconds
+            if until > self._updated:
+                self._updated = until
+                self._tokens = min(self._tokens, 0)
+
+    def slow_down(self, factor=THROTTLE_FACTOR, min_rate=MIN_RATE):
+        """Снизить скорость выдачи токенов.
+
+        Args:
+            factor (float): Во сколько раз изменить скорость.
+            min_rate (float): Наименьшая скорость.
+        """
+        with self._lock:
+            self.rate = max(min_rate, self.rate * factor)
+            self.capacity = max(1, min(self.capacity, self.rate))
+
+
+class RateLimiter:
+    """Лимиты запросов по (площадка, метод API, кабинет).
+
+    Для каждого ключа создается своя корзина токенов. Ответы 420 и 429
+    приостанавливают корзину на время из Retry-After, а если его нет,
+    на THROTTLE_PAUSE секунд со снижением лимита.
+
+    Examples:
+        >>> limiter = RateLimiter({("ozon", "v1/product/import/stocks"): 1})
+        >>> key = ("ozon", "v1/product/import/stocks", client_id)
+        >>> limiter.acquire(key)
+        >>> limiter.observe(key, response.status_code, response.headers)
+    """
+
+    def __init__(self, limits=None, default_rate=DEFAULT_RATE):
+        self.limits = dict(DEFAULT_LIMITS)
+        self.limits.update(limits or {})
+        self.default_rate = default_rate
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def configure(self, limits):
+        """Изменить лимиты методов API.
+
+        Уже созданные корзины получают новую скорость.
+
+        Args:
+            limits (dict): Запросов в секунду по (площадка, метод API).
+        """
+        with self._lock:
+            self.limits.update(limits)
+            for (marketplace, endpoint, _), bucket in self._buckets.items():
+                if (marketplace, endpoint) in limits:
+                    bucket.rate = limits[marketplace, endpoint]
+                    bucket.capacity = max(1, bucket.rate)
+
+    def bucket(self, key):
+        """Получить корзину токенов для ключа.
+
+        Args:
+            key (tuple): Площадка, метод API и кабинет.
+
+        Returns:
+            TokenBucket: Корзина токенов.
+        """
+        with self._lock:
+            if key not in self._buckets:
+                marketplace, endpoint, _ = key
+                rate = self.limits.get((marketplace, endpoint), self.default_rate)
+                self._buckets[key] = TokenBucket(rate)
+            return self._buckets[key]
+
+    def acquire(self, key):
+        """Дождаться разрешения на запрос в текущем потоке.
+
+        Args:
+            key (tuple): Площадка, метод API и кабинет.
+        """
+        delay = self.bucket(key).reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    async def acquire_async(self, key):
+        """Дождаться разрешения на запрос, не блокируя цикл событий.
+
+        Args:
+            key (tuple): Площадка, метод API и кабинет.
+        """
+        delay = self.bucket(key).reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def observe(self, key, status, headers):
+        """Учесть ответ площадки.
+
+        Args:
+            key (tuple): Площадка, метод API и кабинет.
+            status (int): Код ответа.
+            headers (Mapping): Заголовки ответа.
+
+        Returns:
+            float | None: Пауза в секундах, если площадка сообщила о
+            превышении лимита, иначе None.
+        """
+        if status not in THROTTLE_STATUSES:
+            return None
+        bucket = self.bucket(key)
+        retry_after = parse_retry_after(headers.get("Retry-After"))
+        if retry_after is None:
+            retry_after = THROTTLE_PAUSE
+            bucket.slow_down()
+        bucket.pause(retry_after)
+        logger.warning(
+            "%s: превышен лимит запросов, пауза %.1f с, лимит %.2f запросов/с",
+            "/".join(str(part) for part in key),
+            retry_after,
+            bucket.rate,
+        )
+        return retry_after
+
+
+def parse_limits(limits):
+    """Разобрать лимиты из переменной окружения.
+
+    Args:
+        limits (dict): Запросов в секунду по строкам "площадка:метод API".
+
+    Returns:
+        dict: Запросов в секунду по (площадка, метод API).
+
+    Examples:
+        >>> parse_limits({"ozon:v1/product/import/stocks": 1.5})
+        {("ozon", "v1/product/import/stocks"): 1.5}
+    """
+    return {
+        tuple(name.split(":", 1)): float(rate) for name, rate in limits.items()
+    }
+
+
+def parse_retry_after(value):
+    """Разобрать заголовок Retry-After.
+
+    Args:
+        value (str | None): Число секунд или дата HTTP.
+
+    Returns:
+        float | None: Сколько секунд ждать или None, если заголовка нет
+        или его не удалось разобрать.
+
+    Examples:
+        >>> parse_retry_after("3")
+        3.0
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+# Общие лимиты всех клиентов процесса
+LIMITER = RateLimiter()
@@ -0,0 +1,314 @@
+import collections
+import logging.config
+import re
+
+import numpy as np
+
+logger = logging.getLogger(__file__)
+
+
+def remnant_columns(watch_remnants):
+    """Получить колонки Код, Количество и Цена остатков.
+
+    Колонки собираются прямо из словарей, без промежуточного объекта на
+    каждую строку.
+
+    Args:
+        watch_remnants (list): Список словарей с информацией о товарах.
+
+    Returns:
+        skus (list): Артикулы товаров строками.
+        counts (list): Количество в формате файла остатков.
+        prices (list): Цены в формате файла остатков.
+
+    Examples:
+        >>> remnant_columns(watch_remnants)
+        (['48852', '48857'], ['1', '>10'], ["24'570.00 руб.", "8'990.00 руб."])
+    """
+    records = list(watch_remnants)
+    skus = [str(record.get("Код")) for record in records]
+    counts = [record.get("Количество") for record in records]
+    prices = [record.get("Цена") for record in records]
+    return skus, counts, prices
+
+
+NormalizedRemnants = collections.namedtuple(
+    "NormalizedRemnants", ["skus", "stocks", "prices", "bad_stocks", "bad_prices"]
+)
+
+
+def normalize_remnants(watch_remnants):
+    """Привести количество и цены всех остатков к целым числам.
+
+    Колонки Количество и Цена обрабатываются целиком векторными операциями
+    NumPy и одним проходом регулярных выражений по тем же правилам, что и
+    построчно: ">10" означает 100 штук, "1" - 0 штук, от цены остаются
+    цифры до копеек.
+
+    Args:
+        watch_remnants (list): Список словарей с информацией о товарах.
+
+    Returns:
+        NormalizedRemnants: Кортеж из
+            skus (list) - артикулов товаров;
+            stocks (ndarray) - количества товаров для площадок;
+            prices (ndarray) - цен товаров в рублях;
+            bad_stocks (ndarray) - маски строк, количество в которых не
+            удалось разобрать;
+            bad_prices (ndarray) - маски строк, цену в которых не удалось
+            разобрать.
+        Для неразобранных строк количество и цена равны 0.
+
+    Examples:
+        >>> normalize_remnants(watch_remnants)
+        NormalizedRemnants(
+            skus=['48852', '48857'],
+            stocks=array([0, 100]),
+            prices=array([24570, 8990]),
+            bad_stocks=array([False, False]),
+            bad_prices=array([False, False])
+        )
+    """
+    skus, counts, prices_column = remnant_columns(watch_remnants)
+    counts = np.array(counts, dtype=str)
+    stocks = np.zeros(len(counts), dtype=np.int64)
+    more = counts == ">10"
+    numeric = np.char.isdecimal(counts)
+    stocks[numeric] = counts[numeric].astype(np.int64)
+    stocks[more] = 100
+    stocks[counts == "1"] = 0
+    bad_stocks = ~(more | numeric)
+
+    # Вся колонка цен склеивается в одну строку: копейки и все, кроме
+    # цифр, убираются двумя проходами регулярных выражений без pandas
+    prices_text = "\n".join(map(str, prices_column))
+    if prices_text.count("\n") != max(0, len(skus) - 1):
+        # Перевод строки внутри цены сдвинул бы строки, такие цены редки
+        prices_text = "\n".join(
+            str(price).replace("\n", " ") for price in prices_column
+        )
+    prices_text = re.sub(r"\.[^\n]*", "", prices_text)
+    prices_text = re.sub(r"[^0-9\n]", "", prices_text)
+    # Пустая строка - цена без цифр, она помечается -1 и читается NumPy
+    # вместе с остальными одним вызовом
+    prices_text = re.sub(r"^$", "-1", prices_text, flags=re.MULTILINE)
+    prices = np.fromstring(prices_text, dtype=np.int64, sep="\n")[: len(skus)]
+    bad_prices = prices < 0
+    prices[bad_prices] = 0
+    if bad_stocks.any() or bad_prices.any():
+        logger.warning(
+            "Не удалось разобрать количество у %d и цену у %d товаров",
+            bad_stocks.sum(),
+            bad_prices.sum(),
+        )
+    return NormalizedRemnants(skus, stocks, prices, bad_stocks, bad_prices)
+
+
+FeedDiff = collections.namedtuple(
+    "FeedDiff", ["added", "removed", "stock_changed", "price_changed"]
+)
+
+
+def snapshot_remnants(watch_remnants):
+    """Сделать снимок остатков для сравнения со следующим фидом.
+
+    Args:
+        watch_remnants (list | OfferTable): Список словарей с информацией
+        о товарах или уже готовая таблица предложений.
+
+    Returns:
+        snapshot (dict): Количество и цена товаров по артикулам.
+
+    Examples:
+        >>> snapshot_remnants(watch_remnants)
+        {"48852": (0, 24570), "48857": (100, 8990)}
+    """
+    offer_table = OfferTable.from_remnants(watch_remnants)
+    return {
+        sku: (offer_table.stocks[row], offer_table.prices[row])
+        for sku, row in offer_table.rows.items()
+    }
+
+
+def diff_remnants(previous, current):
+    """Сравнить два снимка остатков.
+
+    Args:
+        previous (dict): Снимок прошлого фида.
+        current (dict): Снимок текущего фида.
+
+    Returns:
+        FeedDiff: Кортеж из множеств артикулов:
+            added - появившиеся в фиде;
+            removed - пропавшие из фида;
+            stock_changed - с изменившимся количеством;
+            price_changed - с изменившейся ценой.
+
+    Examples:
+        >>> diff_remnants(
+        ...     {"48852": (0, 24570), "48857": (100, 8990)},
+        ...     {"48852": (2, 24570), "48860": (5, 12000)},
+        ... )
+        FeedDiff(
+            added={'48860'},
+            removed={'48857'},
+            stock_changed={'48852'},
+            price_changed=set()
+        )
+    """
+    added = current.keys() - previous.keys()
+    removed = previous.keys() - current.keys()
+    stock_changed = set()
+    price_changed = set()
+    for sku in current.keys() & previous.keys():
+        stock, price = current[sku]
+        previous_stock, previous_price = previous[sku]
+        if stock != previous_stock:
+            stock_changed.add(sku)
+        if price != previous_price:
+            price_changed.add(sku)
+    return FeedDiff(added, removed, stock_changed, price_changed)
+
+
+OfferJoin = collections.namedtuple(
+    "OfferJoin", ["matched", "feed_only", "catalog_only"]
+)
+
+
+class OfferTable:
+    """Остатки, приведенные к виду, общему для всех площадок.
+
+    Количество и цена всех товаров вычисляются один раз за запуск, после
+    чего из таблицы формируются данные для Ozon и Яндекс Маркета. Если
+    артикул встречается в остатках несколько раз, учитывается первая
+    запись. Колонки хранятся отдельными списками, а не словарем или
+    объектом на строку, поэтому артикул приводится к строке один раз, а
+    create_stocks и create_prices обеих площадок принимают таблицу
+    вместо списка словарей.
+
+    Attributes:
+        skus (list): Артикулы товаров в порядке файла остатков.
+        stocks (list): Количество товаров для площадок.
+        prices (list): Цены товаров в рублях.
+        bad_stocks (list): Признаки строк, количество в которых не удалось
+        разобрать.
+        bad_prices (list): Признаки строк, цену в которых не удалось
+        разобрать.
+        rows (dict): Номер первой строки каждого артикула.
+
+    Examples:
+        >>> offer_table = OfferTable.from_remnants(watch_remnants)
+        >>> list(offer_table.stock_rows(["48852", "136748"]))
+        [("48852", 0), ("136748", 0)]
+        >>> list(offer_table.price_rows(["48852", "136748"]))
+        [("48852", 24570)]
+    """
+
+    __slots__ = ("skus", "stocks", "prices", "bad_stocks", "bad_prices", "rows")
+
+    def __init__(self, skus, stocks, prices, bad_stocks, bad_prices):
+        self.skus = list(skus)
+        self.stocks = list(stocks)
+        self.prices = list(prices)
+        self.bad_stocks = list(bad_stocks)
+        self.bad_prices = list(bad_prices)
+        self.rows = {}
+        for row, sku in enumerate(self.skus):
+            self.rows.setdefault(sku, row)
+
+    @classmethod
+    def from_remnants(cls, watch_remnants):
+        """Построить таблицу по остаткам.
+
+        Args:
+            watch_remnants (list | OfferTable): Список словарей с
+            информацией о товарах. Готовая таблица возвращается без
+            изменений.
+
+        Returns:
+            OfferTable: Таблица предложений.
+        """
+        if isinstance(watch_remnants, cls):
+            return watch_remnants
+        remnants = normalize_remnants(watch_remnants)
+        return cls(
+            remnants.skus,
+            remnants.stocks.tolist(),
+            remnants.prices.tolist(),
+            remnants.bad_stocks.tolist(),
+            remnants.bad_prices.tolist(),
+        )
+
+    def __len__(self):
+        return len(self.rows)
+
+    def join(self, offer_ids):
+        """Сопоставить таблицу с артикулами площадки.
+
+        Строит хэш-индекс артикулов площадки и за один проход по строкам
+        таблицы делит товары на три группы. Список offer_ids не изменяется.
+
+        Args:
+            offer_ids (list): Список артикулов товаров площадки.
+
+        Returns:
+            OfferJoin: Кортеж из трех списков:
+                matched - номера строк товаров, которые есть на площадке, в
+                порядке файла остатков;
+                feed_only - артикулы из остатков, которых нет на площадке;
+                catalog_only - артикулы площадки, которых нет в остатках, в
+                порядке offer_ids.
+
+        Examples:
+            >>> offer_table.join(["48852", "136748"])
+            OfferJoin(matched=[0], feed_only=['48857'], catalog_only=['136748'])
+        """
+        catalog = dict.fromkeys(offer_ids)
+        matched = []
+        feed_only = []
+        for sku, row in self.rows.items():
+            if sku in catalog:
+                matched.append(row)
+            else:
+                feed_only.append(sku)
+        catalog_only = [offer_id for offer_id in catalog if offer_id not in self.rows]
+        return OfferJoin(matched, feed_only, catalog_only)
+
+    def stock_rows(self, offer_ids):
+        """Перебрать количество товаров площадки.
+
+        Товары, которых нет в остатках, получают количество 0. Товары,
+        количество которых не удалось разобрать, пропускаются.
+
+        Args:
+            offer_ids (list): Список артикулов товаров площадки.
+
+        Yields:
+            tuple: Артикул и количество товара.
+        """
+        offer_join = self.join(offer_ids)
+        if offer_join.feed_only:
+            logger.debug(
+                "Нет на площадке товаров из остатков: %d", len(offer_join.feed_only)
+            )
+        for row in offer_join.matched:
+            if not self.bad_stocks[row]:
+                yield self.skus[row], self.stocks[row]
+        for offer_id in offer_join.catalog_only:
+            yield offer_id, 0
+
+    def price_rows(self, offer_ids):
+        """Перебрать цены товаров площадки.
+
+        Товары, которых нет в остатках или цену которых не удалось
+        разобрать, пропускаются.
+
+        Args:
+            offer_ids (list): Список артикулов товаров площадки.
+
+        Yields:
+            tuple: Артикул и цена товара в рублях.
+        """
+        for row in self.join(offer_ids).matched:
+            if not self.bad_prices[row]:
+                yield self.skus[row], self.prices[row]
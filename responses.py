@@ -0,0 +1,111 @@
+import collections
+import logging.config
+
+logger = logging.getLogger(__file__)
+
+ItemError = collections.namedtuple("ItemError", ["offer_id", "code", "message"])
+
+# Коды ошибок Ozon, после которых товар бессмысленно отправлять снова: его
+# нет в кабинете или он в архиве
+PERMANENT_ERRORS = frozenset(
+    {
+        "NOT_FOUND",
+        "PRODUCT_IS_NOT_CREATED",
+        "PRODUCT_IS_ARCHIVED",
+    }
+)
+
+
+def ozon_item_errors(response):
+    """Найти товары, которые Ozon не обновил.
+
+    Args:
+        response (dict): Ответ update_stocks или update_price.
+
+    Returns:
+        list: Ошибки ItemError. Для товара без кода ошибки код пустой.
+
+    Examples:
+        >>> ozon_item_errors(update_stocks(stocks, client_id, seller_token))
+        [ItemError(offer_id='48852', code='NOT_FOUND', message='Product not found')]
+    """
+    errors = []
+    for item in (response or {}).get("result") or []:
+        if item.get("updated", True) and not item.get("errors"):
+            continue
+        item_errors = item.get("errors") or [{}]
+        for error in item_errors:
+            errors.append(
+                ItemError(
+                    item.get("offer_id"),
+                    error.get("code", ""),
+                    error.get("message", ""),
+                )
+            )
+    return errors
+
+
+def yandex_errors(response):
+    """Найти ошибки в ответе Яндекс Маркета.
+
+    Яндекс Маркет обычно не сообщает, к какому товару относится ошибка,
+    тогда offer_id у ошибки None и она относится ко всей части.
+
+    Args:
+        response (dict): Ответ update_stocks или update_price.
+
+    Returns:
+        list: Ошибки ItemError.
+
+    Examples:
+        >>> yandex_errors({"status": "OK", "errors": [{"code": "X", "message": ""}]})
+        [ItemError(offer_id=None, code='X', message='')]
+    """
+    return [
+        ItemError(
+            error.get("offerId") or error.get("sku"),
+            error.get("code", ""),
+            error.get("message", ""),
+        )
+        for error in (response or {}).get("errors") or []
+    ]
+
+
+def is_permanent(error):
+    """Проверить, отклонен ли товар без права повтора.
+
+    Args:
+        error (ItemError): Ошибка товара.
+
+    Returns:
+        bool: True, если код ошибки из PERMANENT_ERRORS.
+    """
+    return error.code in PERMANENT_ERRORS
+
+
+def item_errors(dispatch, analyze):
+    """Собрать ошибки товаров из ответов выгрузки.
+
+    Ошибки, не относящиеся к конкретному товару, только записываются в
+    журнал.
+
+    Args:
+        dispatch (DispatchResult): Результат dispatch_batches.
+        analyze (callable): Разбор ответа, например ozon_item_errors.
+
+    Returns:
+        dict: Первая ошибка ItemError по артикулам.
+    """
+    errors = {}
+    for result in dispatch.results:
+        for error in analyze(result):
+            if error.offer_id is None:
+                logger.warning(
+                    "%s: ошибка части %s: %s",
+                    dispatch.name,
+                    error.code,
+                    error.message,
+                )
+                continue
+            errors.setdefault(str(error.offer_id), error)
+    return errors
@@ -0,0 +1,199 @@
+import asyncio
+import logging.config
+import random
+import sys
+import threading
+import time
+
+import requests
+
+import rate_limit
+
+logger = logging.getLogger(__file__)
+
+# Сколько раз отправлять одну часть, считая первую попытку
+RETRY_ATTEMPTS = 4
+# Сколько повторов всех частей допускается за один запуск
+RETRY_BUDGET = 20
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 30.0
+
+# Ошибки соединения и ожидания, после которых часть можно отправить снова
+RETRY_ERRORS = (
+    requests.exceptions.Timeout,
+    requests.exceptions.ConnectionError,
+    TimeoutError,
+    ConnectionError,
+)
+
+
+class RetryBudget:
+    """Общее на запуск количество повторов.
+
+    Если площадка недоступна, повторы всех частей быстро исчерпывают
+    бюджет, и запуск завершается ошибкой, а не повторяет каждую часть до
+    конца. Бюджет можно использовать из нескольких потоков.
+
+    Attributes:
+        retries (int): Сколько повторов осталось.
+    """
+
+    def __init__(self, retries=RETRY_BUDGET):
+        self.retries = retries
+        self._lock = threading.Lock()
+
+    def take(self):
+        """Забрать один повтор.
+
+        Returns:
+            bool: True, если повтор разрешен.
+        """
+        with self._lock:
+            if self.retries <= 0:
+                return False
+            self.retries -= 1
+            return True
+
+
+def error_response(error):
+    """Получить код и заголовки ответа из ошибки запроса.
+
+    Args:
+        error (Exception): Ошибка requests или aiohttp.
+
+    Returns:
+        status (int | None): Код ответа или None, если ответа не было.
+        headers (Mapping): Заголовки ответа.
+    """
+    response = getattr(error, "response", None)
+    if response is not None:
+        return response.status_code, response.headers
+    return getattr(error, "status", None), getattr(error, "headers", None) or {}
+
+
+def is_retryable(error):
+    """Проверить, можно ли отправить часть после ошибки снова.
+
+    Повторяются ответы 5xx, превышение лимита 420 и 429, ошибки
+    соединения и ожидания. Остальные ошибки, например 400 из-за неверных
+    данных, повторять бессмысленно.
+
+    Args:
+        error (Exception): Ошибка отправки части.
+
+    Returns:
+        bool: True, если ошибка временная.
+    """
+    status, _ = error_response(error)
+    if status is not None:
+        return status >= 500 or status in rate_limit.THROTTLE_STATUSES
+    if isinstance(error, RETRY_ERRORS):
+        return True
+    # Ошибки aiohttp возможны, только если его уже загрузила асинхронная
+    # выгрузка
+    aiohttp = sys.modules.get("aiohttp")
+    return aiohttp is not None and isinstance(error, aiohttp.ClientConnectionError)
+
+
+def retry_delay(error, attempt, attempts=RETRY_ATTEMPTS, budget=None):
+    """Вычислить паузу перед повтором.
+
+    Пауза растет экспоненциально со случайным разбросом, чтобы части
+    из разных потоков не повторялись одновременно, и не меньше
+    Retry-After, если площадка его прислала.
+
+    Args:
+        error (Exception): Ошибка отправки части.
+        attempt (int): Номер неудачной попытки, начиная с 0.
+        attempts (int): Сколько всего попыток допускается.
+        budget (RetryBudget): Бюджет повторов запуска.
+
+    Returns:
+        float | None: Пауза в секундах или None, если повторять нельзя.
+    """
+    if not is_retryable(error) or attempt + 1 >= attempts:
+        return None
+    if budget is not None and not budget.take():
+        logger.warning("Бюджет повторов исчерпан")
+        return None
+    backoff = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2**attempt)
+    delay = backoff * random.uniform(0.5, 1)
+    _, headers = error_response(error)
+    retry_after = rate_limit.parse_retry_after(headers.get("Retry-After"))
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+
+def call_with_retry(func, *args, attempts=RETRY_ATTEMPTS, budget=None, **kwargs):
+    """Вызвать функцию, повторяя ее после временных ошибок.
+
+    Args:
+        func (callable): Функция, например update_stocks.
+        *args: Позиционные аргументы func.
+        attempts (int): Сколько всего попыток допускается.
+        budget (RetryBudget): Бюджет повторов запуска.
+        **kwargs: Именованные аргументы func.
+
+    Returns:
+        Результат func.
+
+    Raises:
+        Exception: Ошибка последней попытки или первая постоянная ошибка.
+
+    Examples:
+        >>> call_with_retry(update_stocks, stocks, client_id, seller_token)
+        {"result": [...]}
+    """
+    attempt = 0
+    while True:
+        try:
+            return func(*args, **kwargs)
+        except Exception as error:
+            delay = retry_delay(error, attempt, attempts, budget)
+            if delay is None:
+                raise
+            logger.warning(
+                "Попытка %d не удалась: %s, повтор через %.1f с",
+                attempt + 1,
+                error,
+                delay,
+            )
+            time.sleep(delay)
+            attempt += 1
+
+
+async def call_with_retry_async(
+    func, *args, attempts=RETRY_ATTEMPTS, budget=None, **kwargs
+):
+    """Вызвать асинхронную функцию, повторяя ее после временных ошибок.
+
+    Args:
+        func (callable): Асинхронная функция.
+        *args: Позиционные аргументы func.
+        attempts (int): Сколько всего попыток допускается.
+        budget (RetryBudget): Бюджет повторов запуска.
+        **kwargs: Именованные аргументы func.
+
+    Returns:
+        Результат func.
+
+    Raises:
+        Exception: Ошибка последней попытки или первая постоянная ошибка.
+    """
+    attempt = 0
+    while True:
+        try:
+            return await func(*args, **kwargs)
+        except Exception as error:
+            delay = retry_delay(error, attempt, attempts, budget)
+            if delay is None:
+                raise
+            logger.warning(
+                "Попытка %d не удалась: %s, повтор через %.1f с",
+                attempt + 1,
+                error,
+                delay,
+            )
+            await asyncio.sleep(delay)
+            attempt += 1
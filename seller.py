@@ -1,17 +1,69 @@
+import asyncio
+import concurrent.futures
+import functools
+import hashlib
 import io
+import itertools
 import logging.config
 import os
 import re
+import tempfile
+import time
 import zipfile
 from environs import Env
 
-import pandas as pd
 import requests
 
+import catalog
+import dispatcher
+import feed_cache
+import http_client
+import payloads
+import rate_limit
+import responses
+import retry
+from remnants import OfferTable
+
 logger = logging.getLogger(__file__)
 
+# Архив меньше этого размера скачивается в память, больший - во временный файл
+ARCHIVE_SPOOL_SIZE = 16 * 1024 * 1024
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# Номер строки заголовка в ostatki.xls и колонки, нужные для выгрузки
+REMNANTS_HEADER_ROW = 17
+REMNANT_COLUMNS = tuple(feed_cache.REMNANT_COLUMNS)
+# Ограничения Ozon на один запрос обновления остатков и цен
+STOCKS_BATCH_SIZE = 100
+PRICES_BATCH_SIZE = 1000
+BATCH_MAX_BYTES = 1024 * 1024
+OZON_API_URL = "https://api-seller.ozon.ru/"
+
+
+@functools.lru_cache(maxsize=None)
+def get_client(client_id, seller_token, pool_size=http_client.UPLOAD_CONCURRENCY):
+    """Получить клиент API Ozon для кабинета.
 
-def get_product_list(last_id, client_id, seller_token):
+    Для одного кабинета и размера пула возвращается один и тот же клиент,
+    поэтому все запросы запуска идут через общий пул соединений.
+
+    Args:
+        client_id (str): Идентификатор клиента Ozon.
+        seller_token (str): API-ключ Ozon.
+        pool_size (int): Сколько соединений держать открытыми.
+
+    Returns:
+        ApiClient: Клиент API Ozon.
+    """
+    headers = {
+        "Client-Id": client_id,
+        "Api-Key": seller_token,
+    }
+    return http_client.ApiClient(
+        OZON_API_URL, headers, pool_size, marketplace="ozon", account=client_id
+    )
+
+
+def get_product_list(last_id, client_id, seller_token, client=None):
     """Получить список товаров магазина Ozon.
 
     Обращается к API Ozon Seller за списком созданных товаров.
@@ -20,6 +72,8 @@ def get_product_list(last_id, client_id, seller_token):
         last_id (str): Идентификатор последнего значения на странице.
         client_id (str): Идентификатор клиента Ozon.
         seller_token (str): API-ключ Ozon.
+        client (ApiClient): Клиент API Ozon. Если не задан, используется
+        общий клиент кабинета, см. get_client.
 
     Returns:
         dict: Ответ Ozon со списком товаров, их количеством и
@@ -55,11 +109,8 @@ def get_product_list(last_id, client_id, seller_token):
             "message": "string"
         }
     """
-    url = "https://api-seller.ozon.ru/v2/product/list"
-    headers = {
-        "Client-Id": client_id,
-        "Api-Key": seller_token,
-    }
+    if client is None:
+        client = get_client(client_id, seller_token)
     payload = {
         "filter": {
             "visibility": "ALL",
@@ -67,20 +118,35 @@ def get_product_list(last_id, client_id, seller_token):
         "last_id": last_id,
         "limit": 1000,
     }
-    response = requests.post(url, json=payload, headers=headers)
-    response.raise_for_status()
-    response_object = response.json()
+    response_object = client.post("v2/product/list", data=payloads.dumps(payload))
     return response_object.get("result")
 
 
-def get_offer_ids(client_id, seller_token):
+def get_offer_ids(
+    client_id,
+    seller_token,
+    catalog_path=None,
+    catalog_ttl=catalog.CATALOG_TTL,
+    refresh=False,
+    context=None,
+    client=None,
+):
     """Получить артикулы товаров магазина Ozon.
 
     Постранично запрашивает артикулы созданных товаров у API Ozon Seller.
+    Если задан catalog_path, артикулы берутся из локальной базы, пока не
+    устареют.
 
     Args:
         client_id (str): Идентификатор клиента Ozon.
         seller_token (str): API-ключ Ozon.
+        catalog_path (str): Путь к базе артикулов SQLite.
+        catalog_ttl (float): Срок актуальности артикулов в базе в секундах.
+        refresh (bool): Запросить артикулы у Ozon, даже если в базе есть
+        актуальные.
+        context (CatalogContext): Артикулы, уже полученные за этот запуск.
+        Если задан, каждый кабинет запрашивается не больше одного раза.
+        client (ApiClient): Клиент API Ozon, см. get_client.
 
     Returns:
         offer_ids (list): Список артикулов товаров Ozon.
@@ -95,22 +161,86 @@ def get_offer_ids(client_id, seller_token):
         >>> get_offer_ids(client_id, seller_token)
         []
     """
+    account = f"ozon:{client_id}"
+    if context is not None:
+        return context.get_offer_ids(
+            account,
+            functools.partial(
+                get_offer_ids,
+                client_id,
+                seller_token,
+                catalog_path=catalog_path,
+                catalog_ttl=catalog_ttl,
+                refresh=refresh,
+                client=client,
+            ),
+        )
+    if catalog_path:
+        return catalog.cached_offer_ids(
+            catalog_path,
+            account,
+            functools.partial(get_offer_ids, client_id, seller_token, client=client),
+            ttl=catalog_ttl,
+            refresh=refresh,
+        )
+    return list(iter_offer_ids(client_id, seller_token, client))
+
+
+def iter_offer_ids(client_id, seller_token, client=None):
+    """Перебрать артикулы товаров магазина Ozon по мере получения страниц.
+
+    Args:
+        client_id (str): Идентификатор клиента Ozon.
+        seller_token (str): API-ключ Ozon.
+        client (ApiClient): Клиент API Ozon, см. get_client.
+
+    Yields:
+        str: Артикул товара Ozon.
+
+    Raises:
+        HTTPError: Если код ответа не 200.
+    """
+    for page in iter_offer_id_pages(client_id, seller_token, client):
+        yield from page
+
+
+def iter_offer_id_pages(client_id, seller_token, client=None):
+    """Постранично запрашивать артикулы товаров магазина Ozon.
+
+    Следующая страница запрашивается, только когда обработана предыдущая,
+    поэтому сопоставление с остатками и выгрузка могут начинаться с первой
+    страницы. Чтобы запрашивать следующую страницу во время обработки
+    текущей, оберните генератор в catalog.prefetch.
+
+    Args:
+        client_id (str): Идентификатор клиента Ozon.
+        seller_token (str): API-ключ Ozon.
+        client (ApiClient): Клиент API Ozon, см. get_client.
+
+    Yields:
+        list: Артикулы товаров Ozon с одной страницы.
+
+    Raises:
+        HTTPError: Если код ответа не 200.
+
+    Examples:
+        >>> list(iter_offer_id_pages(client_id, seller_token))
+        [["136748", "168448"], ["528148", "236297"]]
+    """
     last_id = ""
-    product_list = []
+    received = 0
     while True:
-        some_prod = get_product_list(last_id, client_id, seller_token)
-        product_list.extend(some_prod.get("items"))
+        some_prod = get_product_list(last_id, client_id, seller_token, client)
+        items = some_prod.get("items")
+        yield [product.get("offer_id") for product in items]
+        received += len(items)
         total = some_prod.get("total")
         last_id = some_prod.get("last_id")
-        if total == len(product_list):
+        if total == received or not items:
             break
-    offer_ids = []
-    for product in product_list:
-        offer_ids.append(product.get("offer_id"))
-    return offer_ids
 
 
-def update_price(prices: list, client_id, seller_token):
+def update_price(prices: list, client_id, seller_token, client=None):
     """Обновить цены товаров.
 
     Обновляет на Ozon информацию о стоимости остатков до 1000 товаров.
@@ -119,6 +249,7 @@ def update_price(prices: list, client_id, seller_token):
         prices (list): Список новых цен товаров.
         client_id (str): Идентификатор клиента Ozon.
         seller_token (str): API-ключ Ozon.
+        client (ApiClient): Клиент API Ozon, см. get_client.
 
     Returns:
         dict: Ответ API Ozon в формате json об успешности операции.
@@ -151,18 +282,13 @@ def update_price(prices: list, client_id, seller_token):
             "message": "string"
         }
     """
-    url = "https://api-seller.ozon.ru/v1/product/import/prices"
-    headers = {
-        "Client-Id": client_id,
-        "Api-Key": seller_token,
-    }
-    payload = {"prices": prices}
-    response = requests.post(url, json=payload, headers=headers)
-    response.raise_for_status()
-    return response.json()
+    if client is None:
+        client = get_client(client_id, seller_token)
+    url = "v1/product/import/prices"
+    return client.post(url, data=payloads.encode("prices", prices))
 
 
-def update_stocks(stocks: list, client_id, seller_token):
+def update_stocks(stocks: list, client_id, seller_token, client=None):
     """Обновить остатки.
 
     Обновляет на Ozon информацию о количестве товаров.
@@ -171,6 +297,7 @@ def update_stocks(stocks: list, client_id, seller_token):
         stocks (list): Список обновленного количества товаров.
         client_id (str): Идентификатор клиента Ozon.
         seller_token (str): API-ключ Ozon.
+        client (ApiClient): Клиент API Ozon, см. get_client.
 
     Returns:
         dict: Ответ API Ozon в формате json об успешности операции.
@@ -203,22 +330,33 @@ def update_stocks(stocks: list, client_id, seller_token):
             "message": "string"
         }
     """
-    url = "https://api-seller.ozon.ru/v1/product/import/stocks"
-    headers = {
-        "Client-Id": client_id,
-        "Api-Key": seller_token,
-    }
-    payload = {"stocks": stocks}
-    response = requests.post(url, json=payload, headers=headers)
-    response.raise_for_status()
-    return response.json()
+    if client is None:
+        client = get_client(client_id, seller_token)
+    url = "v1/product/import/stocks"
+    return client.post(url, data=payloads.encode("stocks", stocks))
 
 
-def download_stock():
+def download_stock(in_memory=True, cache_dir=None, backend="auto"):
     """Скачать файл ostatki с сайта casio.
 
     Скачивает архив с файлом остатков товаров с сайта timeworld.ru,
-    преобразуя записи из него в словари.
+    преобразуя записи из него в словари. По умолчанию файл остатков
+    читается прямо из архива в памяти, не создавая временных файлов, что
+    позволяет одновременно запускать seller.py и market.py из одной
+    директории.
+
+    Args:
+        in_memory (bool): Читать ostatki.xls из архива в памяти. Если
+        False, архив распаковывается в текущую директорию, как раньше.
+        cache_dir (str): Директория кэша фида. Если задана, архив
+        запрашивается условным GET-запросом, и при ответе 304 без
+        скачивания и разбора возвращаются остатки из кэша. Разобранные
+        остатки кэшируются по SHA-256 архива, поэтому тот же архив не
+        разбирается повторно. Записи из кэша содержат только колонки Код,
+        Цена и Количество с теми же типами значений, что и при разборе.
+        backend (str): Способ разбора файла остатков, см. parse_remnants.
+        При построчном разборе записи содержат только колонки Код, Цена и
+        Количество.
 
     Returns:
         watch_remnants (list): Список словарей с информацией о товарах.
@@ -230,7 +368,16 @@ def download_stock():
         >>> download_stock()
         [
             {
-                "Код": "48852",
+                "Код": 48852,
+                "Цена": "24'570.00 руб.",
+                "Количество": "1"
+            }
+        ]
+
+        >>> download_stock(backend="pandas")
+        [
+            {
+                "Код": 48852,
                 "Наименование товара": "B 4204 LSSF",
                 "Изображение": "http://www.timeworld.ru/products/itshow.php?id=48857",
                 "Цена": "24'570.00 руб.",
@@ -242,30 +389,244 @@ def download_stock():
     # Скачать остатки с сайта
     casio_url = "https://timeworld.ru/upload/files/ostatki.zip"
     session = requests.Session()
-    response = session.get(casio_url)
+    headers = feed_cache.conditional_headers(cache_dir) if cache_dir else {}
+    response = session.get(casio_url, headers=headers, stream=True)
     response.raise_for_status()
-    with response, zipfile.ZipFile(io.BytesIO(response.content)) as archive:
-        archive.extractall(".")
-    # Создаем список остатков часов:
+    if response.status_code == 304:
+        response.close()
+        watch_remnants = feed_cache.load_last_remnants(cache_dir)
+        if watch_remnants is not None:
+            return watch_remnants
+        # Кэш пропал между запросами - скачать архив заново
+        response = session.get(casio_url, stream=True)
+        response.raise_for_status()
     excel_file = "ostatki.xls"
-    watch_remnants = pd.read_excel(
+    with response, tempfile.SpooledTemporaryFile(
+        max_size=ARCHIVE_SPOOL_SIZE
+    ) as archive_file:
+        digest = stream_download(response, archive_file)
+        if cache_dir:
+            watch_remnants = feed_cache.load_parsed(cache_dir, digest)
+            if watch_remnants is not None:
+                feed_cache.save_feed_meta(cache_dir, response, digest)
+                return watch_remnants
+        with zipfile.ZipFile(archive_file) as archive:
+            if in_memory:
+                xls_content = archive.read(excel_file)
+            else:
+                archive.extractall(".")
+    if in_memory:
+        watch_remnants = parse_remnants(io.BytesIO(xls_content), backend)
+    else:
+        watch_remnants = parse_remnants(excel_file, backend)
+        os.remove("./ostatki.xls")  # Удалить файл
+    if cache_dir:
+        feed_cache.save_parsed(cache_dir, digest, watch_remnants)
+        feed_cache.save_feed_meta(cache_dir, response, digest)
+    return watch_remnants
+
+
+def stream_download(response, file, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """Скачать тело ответа в файл частями.
+
+    Тело ответа не собирается в памяти целиком, а по частям записывается в
+    file. Скорость скачивания выводится в лог.
+
+    Args:
+        response (Response): Ответ, запрошенный с stream=True.
+        file (file-like): Файл, открытый на запись в двоичном режиме.
+        chunk_size (int): Размер части в байтах.
+
+    Returns:
+        str: SHA-256 скачанного содержимого в шестнадцатеричном виде.
+
+    Raises:
+        ConnectionError: Если соединение оборвалось во время скачивания.
+
+    Examples:
+        >>> stream_download(response, archive_file)
+        "9f86d081884c7d659a2feaa0c55ad015a3bf4f1b2b0b822cd15d6c15b0f00a08"
+    """
+    digest = hashlib.sha256()
+    size = 0
+    started = time.perf_counter()
+    for chunk in response.iter_content(chunk_size=chunk_size):
+        file.write(chunk)
+        digest.update(chunk)
+        size += len(chunk)
+    elapsed = time.perf_counter() - started
+    file.seek(0)
+    logger.info(
+        "Скачано %d байт за %.2f с (%.1f КБ/с)",
+        size,
+        elapsed,
+        size / 1024 / elapsed if elapsed else 0,
+    )
+    return digest.hexdigest()
+
+
+def parse_remnants(excel_file, backend="auto"):
+    """Разобрать файл остатков timeworld.ru.
+
+    По умолчанию файл читается построчно через xlrd, и в записи попадают
+    только колонки Код, Цена и Количество. Если построчный разбор не
+    удался, файл разбирается целиком через pandas.
+
+    Args:
+        excel_file (str | file-like): Путь к ostatki.xls или его содержимое.
+        backend (str): Способ разбора: "auto", "xlrd" или "pandas".
+
+    Returns:
+        watch_remnants (list): Список словарей с информацией о товарах.
+
+    Examples:
+        >>> parse_remnants(io.BytesIO(xls_content))
+        [
+            {
+                "Код": 48852,
+                "Цена": "24'570.00 руб.",
+                "Количество": "1"
+            }
+        ]
+
+        >>> parse_remnants(io.BytesIO(xls_content), backend="pandas")
+        [
+            {
+                "Код": 48852,
+                "Наименование товара": "B 4204 LSSF",
+                "Изображение": "http://www.timeworld.ru/products/itshow.php?id=48857",
+                "Цена": "24'570.00 руб.",
+                "Количество": "1",
+                "Заказ": ""
+            }
+        ]
+    """
+    if backend != "auto":
+        return PARSE_BACKENDS[backend](excel_file)
+    try:
+        return parse_remnants_xlrd(excel_file)
+    except Exception as error:
+        logger.warning("Построчный разбор остатков не удался: %s", error)
+    if hasattr(excel_file, "seek"):
+        excel_file.seek(0)
+    return parse_remnants_pandas(excel_file)
+
+
+def parse_remnants_pandas(excel_file):
+    """Разобрать файл остатков целиком через pandas.
+
+    Args:
+        excel_file (str | file-like): Путь к ostatki.xls или его содержимое.
+
+    Returns:
+        watch_remnants (list): Список словарей со всеми колонками файла.
+    """
+    # pandas нужен только для разбора и загружается долго, поэтому
+    # импортируется здесь, а не при запуске
+    import pandas as pd
+
+    # Создаем список остатков часов:
+    return pd.read_excel(
         io=excel_file,
         na_values=None,
         keep_default_na=False,
-        header=17,
+        header=REMNANTS_HEADER_ROW,
     ).to_dict(orient="records")
-    os.remove("./ostatki.xls")  # Удалить файл
-    return watch_remnants
+
+
+def parse_remnants_xlrd(excel_file):
+    """Разобрать файл остатков построчно через xlrd.
+
+    Args:
+        excel_file (str | file-like): Путь к ostatki.xls или его содержимое.
+
+    Returns:
+        watch_remnants (list): Список словарей с колонками Код, Цена и
+        Количество.
+
+    Raises:
+        ValueError: Если в заголовке нет нужных колонок.
+    """
+    return list(iter_remnants(excel_file))
+
+
+def iter_remnants(excel_file, columns=REMNANT_COLUMNS):
+    """Построчно прочитать нужные колонки файла остатков.
+
+    Значения приводятся так же, как при разборе через pandas: целые числа
+    становятся int, пустые ячейки - пустыми строками.
+
+    Args:
+        excel_file (str | file-like): Путь к ostatki.xls или его содержимое.
+        columns (tuple): Названия колонок, которые нужно прочитать.
+
+    Yields:
+        dict: Запись о товаре с колонками из columns.
+
+    Raises:
+        ValueError: Если в заголовке нет нужных колонок.
+
+    Examples:
+        >>> next(iter_remnants("ostatki.xls"))
+        {
+            "Код": 48852,
+            "Цена": "24'570.00 руб.",
+            "Количество": "1"
+        }
+    """
+    import xlrd
+
+    if isinstance(excel_file, (str, os.PathLike)):
+        book = xlrd.open_workbook(excel_file, on_demand=True)
+    else:
+        book = xlrd.open_workbook(file_contents=excel_file.read(), on_demand=True)
+    try:
+        sheet = book.sheet_by_index(0)
+        header = [
+            str(value).strip() for value in sheet.row_values(REMNANTS_HEADER_ROW)
+        ]
+        missing = [column for column in columns if column not in header]
+        if missing:
+            raise ValueError(f"В файле остатков нет колонок: {', '.join(missing)}")
+        indexes = [header.index(column) for column in columns]
+        for row_index in range(REMNANTS_HEADER_ROW + 1, sheet.nrows):
+            row = sheet.row(row_index)
+            yield {
+                column: _cell_value(row[index]) if index < len(row) else ""
+                for column, index in zip(columns, indexes)
+            }
+    finally:
+        book.release_resources()
+
+
+def _cell_value(cell):
+    import xlrd
+
+    if cell.ctype == xlrd.XL_CELL_NUMBER and float(cell.value).is_integer():
+        return int(cell.value)
+    if cell.ctype == xlrd.XL_CELL_BOOLEAN:
+        return bool(cell.value)
+    if cell.ctype in (xlrd.XL_CELL_EMPTY, xlrd.XL_CELL_BLANK):
+        return ""
+    return cell.value
+
+
+PARSE_BACKENDS = {
+    "xlrd": parse_remnants_xlrd,
+    "pandas": parse_remnants_pandas,
+}
 
 
 def create_stocks(watch_remnants, offer_ids):
     """Сформировать список товаров в наличии и их количества.
 
     На основании данных с сайта timeworld.ru заполняет информацию об
-    остатках для Ozon.
+    остатках для Ozon. Товары, количество которых не удалось разобрать,
+    пропускаются.
 
     Args:
-        watch_remnants (list): Список словарей с информацией о товарах.
+        watch_remnants (list | OfferTable): Список словарей с информацией
+        о товарах или таблица предложений.
         offer_ids (list): Список артикулов товаров Ozon.
 
     Returns:
@@ -284,33 +645,19 @@ def create_stocks(watch_remnants, offer_ids):
             }
         ]
     """
-    # Уберем то, что не загружено в seller
-    stocks = []
-    for watch in watch_remnants:
-        if str(watch.get("Код")) in offer_ids:
-            count = str(watch.get("Количество"))
-            if count == ">10":
-                stock = 100
-            elif count == "1":
-                stock = 0
-            else:
-                stock = int(watch.get("Количество"))
-            stocks.append({"offer_id": str(watch.get("Код")), "stock": stock})
-            offer_ids.remove(str(watch.get("Код")))
-    # Добавим недостающее из загруженного:
-    for offer_id in offer_ids:
-        stocks.append({"offer_id": offer_id, "stock": 0})
-    return stocks
+    return list(iter_stocks(OfferTable.from_remnants(watch_remnants), offer_ids))
 
 
 def create_prices(watch_remnants, offer_ids):
     """Обновление цен товаров.
 
     На основании данных с сайта timeworld.ru заполняет информацию о новых
-    ценах для Ozon.
+    ценах для Ozon. Товары, цену которых не удалось разобрать,
+    пропускаются.
 
     Args:
-        watch_remnants (list): Список словарей с информацией о товарах.
+        watch_remnants (list | OfferTable): Список словарей с информацией
+        о товарах или таблица предложений.
         offer_ids (list): Список артикулов товаров озон.
 
     Returns:
@@ -328,18 +675,118 @@ def create_prices(watch_remnants, offer_ids):
             }
         ]
     """
-    prices = []
-    for watch in watch_remnants:
-        if str(watch.get("Код")) in offer_ids:
-            price = {
-                "auto_action_enabled": "UNKNOWN",
-                "currency_code": "RUB",
-                "offer_id": str(watch.get("Код")),
-                "old_price": "0",
-                "price": price_conversion(watch.get("Цена")),
+    return list(iter_prices(OfferTable.from_remnants(watch_remnants), offer_ids))
+
+
+def iter_stocks(offer_table, offer_ids):
+    """Перебрать остатки товаров в формате Ozon.
+
+    Args:
+        offer_table (OfferTable): Таблица предложений.
+        offer_ids (list): Список артикулов товаров Ozon.
+
+    Yields:
+        dict: Количество товара для /v1/product/import/stocks.
+    """
+    # Уберем то, что не загружено в seller, и добавим недостающее
+    for offer_id, stock in offer_table.stock_rows(offer_ids):
+        yield {"offer_id": offer_id, "stock": stock}
+
+
+def iter_prices(offer_table, offer_ids):
+    """Перебрать цены товаров в формате Ozon.
+
+    Args:
+        offer_table (OfferTable): Таблица предложений.
+        offer_ids (list): Список артикулов товаров Ozon.
+
+    Yields:
+        dict: Цена товара для /v1/product/import/prices.
+    """
+    for offer_id, price in offer_table.price_rows(offer_ids):
+        yield {
+            "auto_action_enabled": "UNKNOWN",
+            "currency_code": "RUB",
+            "offer_id": offer_id,
+            "old_price": "0",
+            "price": str(price),
+        }
+
+
+def render_stocks(
+    offer_table,
+    offer_ids,
+    batch_size=STOCKS_BATCH_SIZE,
+    max_bytes=BATCH_MAX_BYTES,
+):
+    """Сформировать остатки для Ozon частями по мере выгрузки.
+
+    Args:
+        offer_table (OfferTable): Таблица предложений.
+        offer_ids (list): Список артикулов товаров Ozon.
+        batch_size (int): Максимальное количество товаров в части.
+        max_bytes (int): Максимальный размер части в JSON.
+
+    Returns:
+        Генератор списков обновленного количества товаров.
+
+    Examples:
+        >>> next(render_stocks(offer_table, offer_ids))
+        [
+            {
+                "offer_id": "48852",
+                "stock": 0
             }
-            prices.append(price)
-    return prices
+        ]
+    """
+    return batched(iter_stocks(offer_table, offer_ids), batch_size, max_bytes)
+
+
+def render_stock_pages(
+    offer_table,
+    offer_id_pages,
+    batch_size=STOCKS_BATCH_SIZE,
+    max_bytes=BATCH_MAX_BYTES,
+):
+    """Сформировать остатки для Ozon частями по мере получения страниц.
+
+    Каждая страница артикулов сопоставляется с таблицей отдельно, поэтому
+    первая часть готова к отправке, когда получена первая страница.
+
+    Args:
+        offer_table (OfferTable): Таблица предложений.
+        offer_id_pages (iterable): Страницы артикулов товаров Ozon,
+        например iter_offer_id_pages.
+        batch_size (int): Максимальное количество товаров в части.
+        max_bytes (int): Максимальный размер части в JSON.
+
+    Returns:
+        Генератор списков обновленного количества товаров.
+    """
+    stocks = itertools.chain.from_iterable(
+        iter_stocks(offer_table, offer_ids) for offer_ids in offer_id_pages
+    )
+    return batched(stocks, batch_size, max_bytes)
+
+
+def render_prices(
+    offer_table,
+    offer_ids,
+    batch_size=PRICES_BATCH_SIZE,
+    max_bytes=BATCH_MAX_BYTES,
+):
+    """Сформировать цены для Ozon частями по мере выгрузки.
+
+    Args:
+        offer_table (OfferTable): Таблица предложений.
+        offer_ids (list): Список артикулов товаров Ozon.
+        batch_size (int): Максимальное количество товаров в части.
+        max_bytes (int): Максимальный размер части в JSON.
+
+    Returns:
+        Генератор списков новых цен товаров.
+    """
+    return batched(iter_prices(offer_table, offer_ids), batch_size, max_bytes)
 
 
 def price_conversion(price: str) -> str:
@@ -363,6 +810,8 @@ def price_conversion(price: str) -> str:
 def divide(lst: list, n: int):
     """Разделить список lst на части по n элементов.
 
+    Оставлена для совместимости, см. batched.
+
     Args:
         lst (list): Список разделяемых элементов.
         n (int): Максимальное количество элементов в части.
@@ -378,29 +827,119 @@ def divide(lst: list, n: int):
             [7, 8, 9]
         ]
     """
-    for i in range(0, len(lst), n):
-        yield lst[i : i + n]
+    return batched(lst, n)
+
+
+def batched(iterable, n: int, max_bytes=None):
+    """Разделить любую последовательность на части по n элементов.
+
+    В отличие от divide, не требует списка и формирует части по мере
+    перебора. Если задан max_bytes, часть заканчивается раньше, когда
+    элементы в JSON перестают в него помещаться. Элемент, который больше
+    max_bytes сам по себе, отдается отдельной частью. Такие части - это
+    payloads.EncodedBatch, из которых тело запроса собирается без
+    повторной сериализации.
+
+    Args:
+        iterable (iterable): Разделяемые элементы.
+        n (int): Максимальное количество элементов в части.
+        max_bytes (int): Максимальный размер списка элементов в JSON.
 
+    Yields:
+        list: Не более n очередных элементов.
+
+    Examples:
+        >>> list(batched(iter(range(1, 8)), 3))
+        [
+            [1, 2, 3],
+            [4, 5, 6],
+            [7]
+        ]
 
-async def upload_prices(watch_remnants, client_id, seller_token):
+        >>> list(batched(["aaaa", "bbbb", "cccc"], 3, max_bytes=16))
+        [
+            ["aaaa", "bbbb"],
+            ["cccc"]
+        ]
+    """
+    iterator = iter(iterable)
+    if max_bytes is None:
+        while True:
+            batch = list(itertools.islice(iterator, n))
+            if not batch:
+                return
+            yield batch
+    # JSON элементов сохраняется в части, чтобы не сериализовать их
+    # второй раз при отправке, см. payloads.encode
+    batch = []
+    encoded = []
+    # Размер "[]" и запятых между элементами
+    size = 2
+    for item in iterator:
+        item_json = payloads.dumps(item)
+        item_size = len(item_json) + 1
+        if batch and (len(batch) >= n or size + item_size > max_bytes):
+            yield payloads.EncodedBatch(batch, encoded)
+            batch = []
+            encoded = []
+            size = 2
+        batch.append(item)
+        encoded.append(item_json)
+        size += item_size
+    if batch:
+        yield payloads.EncodedBatch(batch, encoded)
+
+
+def _skip_invalid_offers(cache_dir, client_id, offer_ids):
+    # Товары, отклоненные Ozon без права повтора, не выгружаются
+    if not cache_dir:
+        return offer_ids
+    invalid_offers = feed_cache.load_invalid_offers(cache_dir, f"ozon_{client_id}")
+    return [sku for sku in offer_ids if sku not in invalid_offers]
+
+
+def _save_invalid_offers(cache_dir, client_id, invalid):
+    if cache_dir and invalid:
+        feed_cache.save_invalid_offers(cache_dir, f"ozon_{client_id}", invalid)
+
+
+async def upload_prices(
+    watch_remnants,
+    client_id,
+    seller_token,
+    context=None,
+    client=None,
+    concurrency=http_client.UPLOAD_CONCURRENCY,
+    retry_budget=None,
+    cache_dir=None,
+):
     """Загрузить список цен на Ozon.
 
     Обновляет цены товаров на Ozon в соответствии с полученными в
-    watch_remnants данными.
+    watch_remnants данными. Части списка отправляются одновременно, но
+    не больше concurrency за раз. Товары, которые Ozon не обновил,
+    отправляются снова, как и в update_remnants.
 
     Args:
-        watch_remnants (list): Список словарей с информацией о товарах.
+        watch_remnants (list | OfferTable): Список словарей с информацией
+        о товарах или таблица предложений.
         client_id (str): Идентификатор клиента Ozon.
         seller_token (str): API-ключ Ozon.
+        context (CatalogContext): Артикулы, уже полученные за этот запуск.
+        client (ApiClient): Клиент API Ozon, см. get_client.
+        concurrency (int): Сколько частей отправляется одновременно.
+        retry_budget (RetryBudget): Бюджет повторов запуска.
+        cache_dir (str): Директория кэша фида для отклоненных товаров.
 
     Returns:
-        prices (list): Список новых цен товаров.
+        prices (list): Список новых цен товаров, принятых Ozon.
 
     Raises:
-        HTTPError: Если код ответа не 200.
+        HTTPError: Если код ответа не 200 при запросе артикулов.
+        DispatchError: Если часть списка не удалось отправить.
 
     Examples:
-        >>> upload_prices(watch_remnants, client_id, seller_token)
+        >>> await upload_prices(watch_remnants, client_id, seller_token)
         [
             {
                 "auto_action_enabled": "UNKNOWN",
@@ -411,34 +950,75 @@ async def upload_prices(watch_remnants, client_id, seller_token):
             }
         ]
     """
-    offer_ids = get_offer_ids(client_id, seller_token)
+    if client is None:
+        client = get_client(client_id, seller_token)
+    # Артикулы запрашиваются синхронно, поэтому в отдельном потоке
+    offer_ids = await asyncio.to_thread(
+        get_offer_ids, client_id, seller_token, context=context, client=client
+    )
+    offer_ids = _skip_invalid_offers(cache_dir, client_id, offer_ids)
     prices = create_prices(watch_remnants, offer_ids)
-    for some_price in list(divide(prices, 1000)):
-        update_price(some_price, client_id, seller_token)
-    return prices
-
-
-async def upload_stocks(watch_remnants, client_id, seller_token):
+    rebatch = functools.partial(batched, n=PRICES_BATCH_SIZE, max_bytes=BATCH_MAX_BYTES)
+    async with http_client.AsyncApiClient(client, concurrency) as async_client:
+        upload = functools.partial(
+            async_client.send_batch, "POST", "v1/product/import/prices", "prices"
+        )
+        dispatch = await dispatcher.dispatch_batches_async(
+            rebatch(prices), upload, f"Ozon {client_id}: цены", retry_budget
+        )
+        resubmit = await dispatcher.resubmit_failed_async(
+            dispatch,
+            upload,
+            responses.ozon_item_errors,
+            "offer_id",
+            rebatch,
+            retry_budget,
+        )
+    _save_invalid_offers(cache_dir, client_id, resubmit.invalid)
+    dispatcher.raise_for_errors(dispatch, resubmit.dispatch)
+    return resubmit.accepted
+
+
+async def upload_stocks(
+    watch_remnants,
+    client_id,
+    seller_token,
+    context=None,
+    client=None,
+    concurrency=http_client.UPLOAD_CONCURRENCY,
+    retry_budget=None,
+    cache_dir=None,
+):
     """Загрузить количество товаров на Ozon.
 
     Обновляет количество товаров на Ozon в соответствии с полученными в
     watch_remnants данными. Формирует отдельным списком товары, которые
-    есть в наличии. 
+    есть в наличии. Части списка отправляются одновременно, но не больше
+    concurrency за раз. Товары, которые Ozon не обновил, отправляются
+    снова, как и в update_remnants.
 
     Args:
-        watch_remnants (list): Список словарей с информацией о товарах.
+        watch_remnants (list | OfferTable): Список словарей с информацией
+        о товарах или таблица предложений.
         client_id (str): Идентификатор клиента Ozon.
         seller_token (str): API-ключ Ozon.
+        context (CatalogContext): Артикулы, уже полученные за этот запуск.
+        client (ApiClient): Клиент API Ozon, см. get_client.
+        concurrency (int): Сколько частей отправляется одновременно.
+        retry_budget (RetryBudget): Бюджет повторов запуска.
+        cache_dir (str): Директория кэша фида для отклоненных товаров.
 
     Returns:
         not_empty (list): Список товаров, которые есть в наличии.
-        stocks (list): Список обновленного количества товаров.
+        stocks (list): Список обновленного количества товаров, принятых
+        Ozon.
 
     Raises:
-        HTTPError: Если код ответа не 200.
+        HTTPError: Если код ответа не 200 при запросе артикулов.
+        DispatchError: Если часть списка не удалось отправить.
 
     Examples:
-        >>> upload_stocks(watch_remnants, client_id, seller_token)
+        >>> await upload_stocks(watch_remnants, client_id, seller_token)
         [
             {
                 "offer_id": "48857",
@@ -456,29 +1036,361 @@ async def upload_stocks(watch_remnants, client_id, seller_token):
             }
         ]
     """
-    offer_ids = get_offer_ids(client_id, seller_token)
+    if client is None:
+        client = get_client(client_id, seller_token)
+    # Артикулы запрашиваются синхронно, поэтому в отдельном потоке
+    offer_ids = await asyncio.to_thread(
+        get_offer_ids, client_id, seller_token, context=context, client=client
+    )
+    offer_ids = _skip_invalid_offers(cache_dir, client_id, offer_ids)
     stocks = create_stocks(watch_remnants, offer_ids)
-    for some_stock in list(divide(stocks, 100)):
-        update_stocks(some_stock, client_id, seller_token)
+    rebatch = functools.partial(batched, n=STOCKS_BATCH_SIZE, max_bytes=BATCH_MAX_BYTES)
+    async with http_client.AsyncApiClient(client, concurrency) as async_client:
+        upload = functools.partial(
+            async_client.send_batch, "POST", "v1/product/import/stocks", "stocks"
+        )
+        dispatch = await dispatcher.dispatch_batches_async(
+            rebatch(stocks), upload, f"Ozon {client_id}: остатки", retry_budget
+        )
+        resubmit = await dispatcher.resubmit_failed_async(
+            dispatch,
+            upload,
+            responses.ozon_item_errors,
+            "offer_id",
+            rebatch,
+            retry_budget,
+        )
+    _save_invalid_offers(cache_dir, client_id, resubmit.invalid)
+    dispatcher.raise_for_errors(dispatch, resubmit.dispatch)
+    stocks = resubmit.accepted
     not_empty = list(filter(lambda stock: (stock.get("stock") != 0), stocks))
     return not_empty, stocks
 
 
+def upload_remnants(
+    watch_remnants,
+    client_id,
+    seller_token,
+    context=None,
+    client=None,
+    concurrency=http_client.UPLOAD_CONCURRENCY,
+    retry_budget=None,
+    cache_dir=None,
+):
+    """Загрузить количество и цены товаров на Ozon из синхронного кода.
+
+    Запускает upload_stocks и upload_prices одновременно в новом цикле
+    событий, например из main при UPLOAD_MODE=async. Нужен aiohttp.
+    Ошибка одной выгрузки сообщается после завершения обеих.
+
+    Args:
+        watch_remnants (list | OfferTable): Список словарей с информацией
+        о товарах или таблица предложений.
+        client_id (str): Идентификатор клиента Ozon.
+        seller_token (str): API-ключ Ozon.
+        context (CatalogContext): Артикулы, уже полученные за этот запуск.
+        client (ApiClient): Клиент API Ozon, см. get_client.
+        concurrency (int): Сколько частей отправляется одновременно.
+        retry_budget (RetryBudget): Бюджет повторов запуска.
+        cache_dir (str): Директория кэша фида для отклоненных товаров.
+
+    Returns:
+        stocks (list): Список обновленного количества товаров, принятых
+        Ozon.
+        prices (list): Список новых цен товаров, принятых Ozon.
+
+    Raises:
+        HTTPError: Если код ответа не 200 при запросе артикулов.
+        DispatchError: Если часть списка не удалось отправить.
+    """
+    offer_table = OfferTable.from_remnants(watch_remnants)
+    if retry_budget is None:
+        retry_budget = retry.RetryBudget()
+    if context is None:
+        context = catalog.CatalogContext()
+
+    async def upload():
+        return await asyncio.gather(
+            upload_stocks(
+                offer_table,
+                client_id,
+                seller_token,
+                context,
+                client,
+                concurrency,
+                retry_budget,
+                cache_dir,
+            ),
+            upload_prices(
+                offer_table,
+                client_id,
+                seller_token,
+                context,
+                client,
+                concurrency,
+                retry_budget,
+                cache_dir,
+            ),
+            return_exceptions=True,
+        )
+
+    results = asyncio.run(upload())
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    (_, stocks), prices = results
+    return stocks, prices
+
+
+def update_remnants(
+    watch_remnants,
+    client_id,
+    seller_token,
+    cache_dir=None,
+    changed_only=False,
+    full_sync_interval=feed_cache.FULL_SYNC_INTERVAL,
+    offer_ids=None,
+    context=None,
+    client=None,
+    concurrency=http_client.UPLOAD_CONCURRENCY,
+    retry_budget=None,
+    offer_id_pages=None,
+):
+    """Обновить остатки и цены товаров на Ozon.
+
+    Части списков отправляются в пуле потоков, см.
+    dispatcher.dispatch_batches. Если часть не удалось отправить,
+    остальные все равно отправляются, а ошибка сообщается в конце.
+    Товары, которые Ozon не обновил, отправляются снова отдельными
+    частями, см. dispatcher.resubmit_failed. Если задан cache_dir,
+    товары, отклоненные Ozon без права повтора, сохраняются и не
+    выгружаются feed_cache.INVALID_OFFER_TTL секунд. Если заданы
+    offer_id_pages, остатки отправляются по мере получения страниц
+    артикулов, а цены - после того, как получены все страницы.
+
+    Args:
+        watch_remnants (list | OfferTable): Список словарей с информацией
+        о товарах или таблица предложений.
+        client_id (str): Идентификатор клиента Ozon.
+        seller_token (str): API-ключ Ozon.
+        cache_dir (str): Директория кэша фида для снимка выгруженных
+        остатков и отклоненных товаров.
+        changed_only (bool): Выгружать только товары, изменившиеся с
+        прошлого запуска. Работает, только если задан cache_dir.
+        full_sync_interval (float): Период полной выгрузки всех товаров в
+        секундах при changed_only.
+        offer_ids (list): Уже полученный список артикулов товаров Ozon.
+        Если не задан, запрашивается у Ozon.
+        context (CatalogContext): Артикулы, уже полученные за этот запуск.
+        client (ApiClient): Клиент API Ozon, см. get_client.
+        concurrency (int): Сколько частей отправляется одновременно.
+        retry_budget (RetryBudget): Бюджет повторов запуска.
+        offer_id_pages (iterable): Страницы артикулов товаров Ozon вместо
+        offer_ids, например catalog.prefetch(iter_offer_id_pages(...)).
+
+    Returns:
+        stocks (list): Список обновленного количества товаров, принятых
+        Ozon.
+        prices (list): Список новых цен товаров, принятых Ozon.
+
+    Raises:
+        HTTPError: Если код ответа не 200 при запросе артикулов.
+        DispatchError: Если часть списка не удалось отправить.
+    """
+    if offer_id_pages is None:
+        if offer_ids is None:
+            offer_ids = get_offer_ids(
+                client_id, seller_token, context=context, client=client
+            )
+        offer_id_pages = [offer_ids]
+    offer_table = OfferTable.from_remnants(watch_remnants)
+    if retry_budget is None:
+        retry_budget = retry.RetryBudget()
+    snapshot_name = f"ozon_{client_id}"
+    plan = None
+    if cache_dir and changed_only:
+        plan = feed_cache.plan_sync(
+            cache_dir, snapshot_name, offer_table, full_sync_interval
+        )
+    offer_ids = []
+
+    def stock_pages():
+        # Цены отправляются по всем артикулам, поэтому страницы
+        # запоминаются, пока по ним формируются остатки
+        for page in offer_id_pages:
+            offer_ids.extend(page)
+            stock_ids = _skip_invalid_offers(cache_dir, client_id, page)
+            if plan and plan.stock_skus is not None:
+                stock_ids = [sku for sku in stock_ids if sku in plan.stock_skus]
+            yield stock_ids
+
+    # Обновить остатки
+    upload_stocks_batch = functools.partial(
+        update_stocks, client_id=client_id, seller_token=seller_token, client=client
+    )
+    stocks = dispatcher.dispatch_batches(
+        render_stock_pages(offer_table, stock_pages()),
+        upload_stocks_batch,
+        concurrency,
+        f"Ozon {client_id}: остатки",
+        retry_budget,
+    )
+    stocks_retry = dispatcher.resubmit_failed(
+        stocks,
+        upload_stocks_batch,
+        responses.ozon_item_errors,
+        "offer_id",
+        functools.partial(batched, n=STOCKS_BATCH_SIZE, max_bytes=BATCH_MAX_BYTES),
+        concurrency,
+        retry_budget,
+    )
+    # Поменять цены
+    price_ids = _skip_invalid_offers(cache_dir, client_id, offer_ids)
+    if plan and plan.price_skus is not None:
+        price_ids = [sku for sku in price_ids if sku in plan.price_skus]
+    upload_prices_batch = functools.partial(
+        update_price, client_id=client_id, seller_token=seller_token, client=client
+    )
+    prices = dispatcher.dispatch_batches(
+        render_prices(offer_table, price_ids),
+        upload_prices_batch,
+        concurrency,
+        f"Ozon {client_id}: цены",
+        retry_budget,
+    )
+    prices_retry = dispatcher.resubmit_failed(
+        prices,
+        upload_prices_batch,
+        responses.ozon_item_errors,
+        "offer_id",
+        functools.partial(batched, n=PRICES_BATCH_SIZE, max_bytes=BATCH_MAX_BYTES),
+        concurrency,
+        retry_budget,
+    )
+    _save_invalid_offers(
+        cache_dir, client_id, {**stocks_retry.invalid, **prices_retry.invalid}
+    )
+    dispatcher.raise_for_errors(
+        stocks, stocks_retry.dispatch, prices, prices_retry.dispatch
+    )
+    # Не принятые товары должны попасть в следующую выгрузку изменений
+    if plan and not (stocks_retry.failed or prices_retry.failed):
+        feed_cache.save_snapshot(
+            cache_dir, snapshot_name, plan.snapshot, plan.full_sync_at
+        )
+    return stocks_retry.accepted, prices_retry.accepted
+
+
+def fetch_offers_and_remnants(
+    client_id, seller_token, cache_dir=None, client=None, **catalog_options
+):
+    """Одновременно получить артикулы Ozon и остатки timeworld.ru.
+
+    Постраничный запрос артикулов у Ozon и скачивание с разбором файла
+    остатков независимы, поэтому выполняются в двух потоках.
+
+    Args:
+        client_id (str): Идентификатор клиента Ozon.
+        seller_token (str): API-ключ Ozon.
+        cache_dir (str): Директория кэша фида, см. download_stock.
+        client (ApiClient): Клиент API Ozon, см. get_client.
+        **catalog_options: Настройки кэша артикулов, см. get_offer_ids.
+
+    Returns:
+        offer_ids (list): Список артикулов товаров Ozon.
+        offer_table (OfferTable): Таблица предложений по остаткам.
+
+    Raises:
+        HTTPError: Если код ответа не 200.
+
+    Examples:
+        >>> fetch_offers_and_remnants(client_id, seller_token)
+        (["48852", "48857"], <OfferTable>)
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        offer_ids = executor.submit(
+            get_offer_ids, client_id, seller_token, client=client, **catalog_options
+        )
+        watch_remnants = executor.submit(
+            lambda: OfferTable.from_remnants(download_stock(cache_dir=cache_dir))
+        )
+        return offer_ids.result(), watch_remnants.result()
+
+
 def main():
     env = Env()
+    logging.basicConfig(
+        level=env.str("LOG_LEVEL", "INFO"),
+        format="%(asctime)s %(levelname)s %(message)s",
+    )
     seller_token = env.str("SELLER_TOKEN")
     client_id = env.str("CLIENT_ID")
+    feed_cache_dir = env.str("FEED_CACHE_DIR", None)
+    changed_only = env.bool("CHANGED_ONLY", False)
+    full_sync_interval = env.float("FULL_SYNC_HOURS", 24) * 60 * 60
+    catalog_options = {
+        "catalog_path": env.str("CATALOG_CACHE", None),
+        "catalog_ttl": env.float("CATALOG_TTL_HOURS", 6) * 60 * 60,
+        "refresh": env.bool("CATALOG_REFRESH", False),
+        "context": catalog.CatalogContext(),
+    }
+    concurrency = env.int("UPLOAD_CONCURRENCY", http_client.UPLOAD_CONCURRENCY)
+    rate_limit.LIMITER.configure(
+        rate_limit.parse_limits(env.dict("RATE_LIMITS", {}))
+    )
+    client = get_client(client_id, seller_token, concurrency)
+    retry_budget = retry.RetryBudget(env.int("RETRY_BUDGET", retry.RETRY_BUDGET))
+    # Выгрузка изменений ведется только в пуле потоков
+    upload_async = env.str("UPLOAD_MODE", "threads") == "async" and not changed_only
     try:
-        offer_ids = get_offer_ids(client_id, seller_token)
-        watch_remnants = download_stock()
-        # Обновить остатки
-        stocks = create_stocks(watch_remnants, offer_ids)
-        for some_stock in list(divide(stocks, 100)):
-            update_stocks(some_stock, client_id, seller_token)
-        # Поменять цены
-        prices = create_prices(watch_remnants, offer_ids)
-        for some_price in list(divide(prices, 900)):
-            update_price(some_price, client_id, seller_token)
+        if not upload_async and not catalog_options["catalog_path"]:
+            # Без базы артикулов остатки отправляются по мере получения
+            # страниц, следующая страница запрашивается во время отправки
+            offer_table = OfferTable.from_remnants(
+                download_stock(cache_dir=feed_cache_dir)
+            )
+            update_remnants(
+                offer_table,
+                client_id,
+                seller_token,
+                cache_dir=feed_cache_dir,
+                changed_only=changed_only,
+                full_sync_interval=full_sync_interval,
+                client=client,
+                concurrency=concurrency,
+                retry_budget=retry_budget,
+                offer_id_pages=catalog.prefetch(
+                    iter_offer_id_pages(client_id, seller_token, client)
+                ),
+            )
+            return
+        offer_ids, offer_table = fetch_offers_and_remnants(
+            client_id, seller_token, feed_cache_dir, client, **catalog_options
+        )
+        if upload_async:
+            upload_remnants(
+                offer_table,
+                client_id,
+                seller_token,
+                catalog_options["context"],
+                client,
+                concurrency,
+                retry_budget,
+                feed_cache_dir,
+            )
+            return
+        update_remnants(
+            offer_table,
+            client_id,
+            seller_token,
+            cache_dir=feed_cache_dir,
+            changed_only=changed_only,
+            full_sync_interval=full_sync_interval,
+            offer_ids=offer_ids,
+            client=client,
+            concurrency=concurrency,
+            retry_budget=retry_budget,
+        )
     except requests.exceptions.ReadTimeout:
         print("Превышено время ожидания...")
     except requests.exceptions.ConnectionError as error:
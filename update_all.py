@@ -0,0 +1,217 @@
+import concurrent.futures
+import functools
+import logging.config
+from environs import Env
+
+import requests
+
+import catalog
+import http_client
+import market
+import rate_limit
+import retry
+import seller
+from remnants import OfferTable
+
+logger = logging.getLogger(__file__)
+
+
+def run_tasks(tasks, max_workers=None):
+    """Выполнить задачи в пуле потоков с учетом зависимостей.
+
+    Задача запускается, как только готовы результаты всех задач, от которых
+    она зависит. Результаты зависимостей передаются ей позиционными
+    аргументами в порядке перечисления. Если зависимость завершилась
+    ошибкой, зависящая задача не запускается.
+
+    Args:
+        tasks (dict): Задачи вида {имя: (функция, [имена зависимостей])}.
+        max_workers (int): Количество потоков. По умолчанию по одному на
+        задачу.
+
+    Returns:
+        results (dict): Результаты успешно выполненных задач по именам.
+        errors (dict): Исключения невыполненных задач по именам.
+
+    Examples:
+        >>> run_tasks({
+        ...     "feed": (download_stock, []),
+        ...     "ozon": (partial(update_remnants, client_id=client_id,
+        ...                      seller_token=seller_token), ["feed"]),
+        ... })
+        (
+            {"feed": [...], "ozon": ([...], [...])},
+            {}
+        )
+    """
+    results = {}
+    errors = {}
+    pending = dict(tasks)
+    running = {}
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=max_workers or len(tasks) or 1
+    ) as executor:
+        while pending or running:
+            scheduled = True
+            while scheduled:
+                scheduled = False
+                for name, (func, deps) in list(pending.items()):
+                    failed = [dep for dep in deps if dep in errors or dep not in tasks]
+                    if failed:
+                        errors[name] = RuntimeError(
+                            f"Не выполнены зависимости задачи {name}: {', '.join(failed)}"
+                        )
+                    elif all(dep in results for dep in deps):
+                        args = [results[dep] for dep in deps]
+                        running[executor.submit(func, *args)] = name
+                    else:
+                        continue
+                    del pending[name]
+                    scheduled = True
+            if not running:
+                # Остались только задачи с циклическими зависимостями
+                for name in pending:
+                    errors[name] = RuntimeError(
+                        f"Циклическая зависимость задачи {name}"
+                    )
+                break
+            done, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except Exception as error:
+                    errors[name] = error
+    return results, errors
+
+
+def update_target(update, watch_remnants, offer_ids, **kwargs):
+    """Обновить площадку остатками и артикулами из результатов задач.
+
+    Args:
+        update (callable): Функция update_remnants модуля площадки.
+        watch_remnants (OfferTable): Таблица предложений по остаткам.
+        offer_ids (list): Список артикулов товаров площадки.
+        **kwargs: Остальные аргументы update_remnants.
+
+    Returns:
+        stocks (list): Список обновленного количества товаров.
+        prices (list): Список новых цен товаров.
+    """
+    return update(watch_remnants, offer_ids=offer_ids, **kwargs)
+
+
+def report_error(name, error):
+    """Вывести ошибку задачи в том же виде, что и main скриптов."""
+    if isinstance(error, requests.exceptions.ReadTimeout):
+        print(name, "Превышено время ожидания...")
+    elif isinstance(error, requests.exceptions.ConnectionError):
+        print(name, error, "Ошибка соединения")
+    else:
+        print(name, error, "ERROR_2")
+
+
+def main():
+    env = Env()
+    logging.basicConfig(
+        level=env.str("LOG_LEVEL", "INFO"),
+        format="%(asctime)s %(levelname)s %(message)s",
+    )
+    seller_token = env.str("SELLER_TOKEN")
+    client_id = env.str("CLIENT_ID")
+    market_token = env.str("MARKET_TOKEN")
+    campaign_fbs_id = env.str("FBS_ID")
+    campaign_dbs_id = env.str("DBS_ID")
+    warehouse_fbs_id = env.str("WAREHOUSE_FBS_ID")
+    warehouse_dbs_id = env.str("WAREHOUSE_DBS_ID")
+    feed_cache_dir = env.str("FEED_CACHE_DIR", None)
+    concurrency = env.int("UPLOAD_CONCURRENCY", http_client.UPLOAD_CONCURRENCY)
+    sync_options = {
+        "cache_dir": feed_cache_dir,
+        "changed_only": env.bool("CHANGED_ONLY", False),
+        "full_sync_interval": env.float("FULL_SYNC_HOURS", 24) * 60 * 60,
+        "concurrency": concurrency,
+        # Бюджет повторов общий для всех площадок запуска
+        "retry_budget": retry.RetryBudget(
+            env.int("RETRY_BUDGET", retry.RETRY_BUDGET)
+        ),
+    }
+
+    catalog_options = {
+        "catalog_path": env.str("CATALOG_CACHE", None),
+        "catalog_ttl": env.float("CATALOG_TTL_HOURS", 6) * 60 * 60,
+        "refresh": env.bool("CATALOG_REFRESH", False),
+        "context": catalog.CatalogContext(),
+    }
+    rate_limit.LIMITER.configure(
+        rate_limit.parse_limits(env.dict("RATE_LIMITS", {}))
+    )
+    ozon_client = seller.get_client(client_id, seller_token, concurrency)
+    # Обе кампании Яндекс Маркета выгружаются одновременно через один клиент
+    market_client = market.get_client(market_token, 2 * concurrency)
+
+    # Остатки скачиваются один раз и раздаются всем площадкам, артикулы
+    # площадок запрашиваются одновременно со скачиванием остатков
+    tasks = {
+        "feed": (
+            functools.partial(seller.download_stock, cache_dir=feed_cache_dir),
+            [],
+        ),
+        "offers": (OfferTable.from_remnants, ["feed"]),
+        "ozon_catalog": (
+            functools.partial(
+                seller.get_offer_ids,
+                client_id,
+                seller_token,
+                client=ozon_client,
+                **catalog_options,
+            ),
+            [],
+        ),
+        "ozon": (
+            functools.partial(
+                update_target,
+                seller.update_remnants,
+                client_id=client_id,
+                seller_token=seller_token,
+                client=ozon_client,
+                **sync_options,
+            ),
+            ["offers", "ozon_catalog"],
+        ),
+    }
+    for name, campaign_id, warehouse_id in (
+        ("yandex_fbs", campaign_fbs_id, warehouse_fbs_id),
+        ("yandex_dbs", campaign_dbs_id, warehouse_dbs_id),
+    ):
+        tasks[f"{name}_catalog"] = (
+            functools.partial(
+                market.get_offer_ids,
+                campaign_id,
+                market_token,
+                client=market_client,
+                **catalog_options,
+            ),
+            [],
+        )
+        tasks[name] = (
+            functools.partial(
+                update_target,
+                market.update_remnants,
+                campaign_id=campaign_id,
+                market_token=market_token,
+                warehouse_id=warehouse_id,
+                client=market_client,
+                **sync_options,
+            ),
+            ["offers", f"{name}_catalog"],
+        )
+    _, errors = run_tasks(tasks)
+    for name, error in errors.items():
+        report_error(name, error)
+
+
+if __name__ == "__main__":
+    main()